@@ -0,0 +1,121 @@
+import os
+
+
+INDEXED_FIELDS = ('image_name', 'image_path', 'patient_id', 'body_part', 'annotation_type')
+
+MEMBERSHIP_TYPES = (list, set, frozenset)
+
+
+class AnnotationIndex:
+    """
+    Annotations of a data dictionary with hash indexes on the most queried fields.
+
+    Queries take any number of field=value criteria. A list or set as value matches any of
+    its members. Indexed fields are answered from the indexes, other fields are compared on
+    the remaining candidates only.
+    """
+
+    def __init__(self, fields=INDEXED_FIELDS):
+        self.records = []
+        self._indexes = {field: {} for field in fields}
+
+    @classmethod
+    def from_data(cls, data, fields=INDEXED_FIELDS):
+        index = cls(fields)
+        for image_name, annotations in data.items():
+            for annotation_number, details in annotations.items():
+                index.add(image_name, annotation_number, details)
+        return index
+
+    def add(self, image_name, annotation_number, details):
+        record_id = len(self.records)
+        self.records.append((image_name, annotation_number, details))
+
+        for field, index in self._indexes.items():
+            value = image_name if field == 'image_name' else details.get(field)
+            index.setdefault(value, set()).add(record_id)
+
+    @staticmethod
+    def _value(record, field):
+        image_name, _, details = record
+        return image_name if field == 'image_name' else details.get(field)
+
+    def query(self, **criteria):
+        """
+        :return: Sorted ids of the records matching all criteria.
+        """
+        candidates = []
+        unindexed = {}
+        for field, value in criteria.items():
+            if field not in self._indexes:
+                unindexed[field] = value
+                continue
+
+            index = self._indexes[field]
+            if isinstance(value, MEMBERSHIP_TYPES):
+                candidates.append(set().union(*(index.get(v, set()) for v in value)))
+            else:
+                candidates.append(index.get(value, set()))
+
+        if candidates:
+            candidates.sort(key=len)
+            record_ids = set(candidates[0]).intersection(*candidates[1:])
+        else:
+            record_ids = set(range(len(self.records)))
+
+        for field, value in unindexed.items():
+            if isinstance(value, MEMBERSHIP_TYPES):
+                record_ids = {i for i in record_ids if self._value(self.records[i], field) in value}
+            else:
+                record_ids = {i for i in record_ids if self._value(self.records[i], field) == value}
+
+        return sorted(record_ids)
+
+    def filter(self, **criteria):
+        """
+        :return: A dictionary of the matching annotations with the structure of the original data.
+        """
+        filtered_data = {}
+        for record_id in self.query(**criteria):
+            image_name, annotation_number, details = self.records[record_id]
+            filtered_data.setdefault(image_name, {})[annotation_number] = details
+
+        return filtered_data
+
+    def values(self, field):
+        return list(self._indexes[field]) if field in self._indexes else None
+
+
+class ImagePathIndex:
+    """
+    Resolves image names to paths of a grouped file dictionary (patient -> body part -> paths).
+
+    Paths are looked up by their full path, file name and file name without extension.
+    """
+
+    def __init__(self, hsi_dict):
+        self.hsi_dict = hsi_dict
+        self._paths = {}
+
+        for patient_id, body_parts in hsi_dict.items():
+            for body_part, paths in body_parts.items():
+                for path in paths:
+                    file_name = os.path.basename(path)
+                    for key in (os.path.normpath(path), file_name, os.path.splitext(file_name)[0]):
+                        self._paths[(patient_id, body_part, key)] = path
+
+    def resolve(self, image_name, patient_id, body_part):
+        """
+        :return: Path of the image, or None if it isn't found or the patient or body part is unknown.
+        """
+        path = self._paths.get((patient_id, body_part, os.path.normpath(image_name)))
+        if path is not None:
+            return path
+
+        # Names that are only part of a file name fall back to the substring search
+        mapped_image = None
+        for path in self.hsi_dict.get(patient_id, {}).get(body_part, []):
+            if image_name in path:
+                mapped_image = path
+
+        return mapped_image
@@ -0,0 +1,208 @@
+"""
+Benchmarks of the loading, calibration and extraction hot paths on synthetic cubes.
+
+cuvis is replaced by the stand-in in fake_cuvis, so the benchmarks run without the SDK and
+measure the code of this repository rather than the vendor decoder.
+
+Usage:
+    python benchmarks/bench_pipeline.py --height 410 --width 410 --images 8 --output results.json
+    python benchmarks/bench_pipeline.py --output new.json --compare results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_cuvis
+sys.modules['cuvis'] = fake_cuvis
+
+from hsi_processor import HSIProcessor
+from spectral_resampling import SpectralResampler
+from spectral_features import FeatureEngine
+import hsi_analysis
+
+
+def create_dataset(directory, args, rng):
+    height, width, bands = args.height, args.width, args.bands
+
+    dark = rng.integers(90, 110, size=(height, width, bands), dtype=np.uint16)
+    white = rng.integers(3900, 4100, size=(height, width, bands), dtype=np.uint16)
+    dark_path = os.path.join(directory, 'dark.cu3s')
+    white_path = os.path.join(directory, 'white.cu3s')
+    fake_cuvis.save_session(dark_path, dark)
+    fake_cuvis.save_session(white_path, white)
+
+    raw_paths = []
+    reflectance_paths = []
+    data = {}
+    for i in range(args.images):
+        image_dir = os.path.join(directory, f'p{i % 4}', 'arms')
+        os.makedirs(image_dir, exist_ok=True)
+
+        raw_path = os.path.join(image_dir, f'Raw_{i:03d}.cu3s')
+        fake_cuvis.save_session(raw_path, rng.integers(100, 4000, size=(height, width, bands), dtype=np.uint16))
+        raw_paths.append(raw_path)
+
+        image_name = f'Auto_{i:03d}'
+        reflectance_path = os.path.join(image_dir, image_name + '.cu3s')
+        fake_cuvis.save_session(reflectance_path, rng.integers(0, 10000, size=(height, width, bands), dtype=np.uint16),
+                                mode='Reflectance', wavelength=np.linspace(450, 950, bands))
+        reflectance_paths.append(reflectance_path)
+
+        xs = rng.integers(0, width, size=args.annotations)
+        ys = rng.integers(0, height, size=args.annotations)
+        data[image_name] = {j: {'image_path': reflectance_path,
+                                'patient_id': f'p{i % 4}',
+                                'body_part': 'arms',
+                                'annotation_type': 'skin' if j % 2 else 'lesion',
+                                'coordinates': (int(x), int(y))}
+                            for j, (x, y) in enumerate(zip(xs, ys))}
+
+    return dark_path, white_path, raw_paths, reflectance_paths, data
+
+
+def measure(function, repeat):
+    """
+    :return: Tuple of the best wall time over repeat runs and the peak traced memory of one extra run.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+
+    # Memory is traced in a separate run, so tracing doesn't distort the timings
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def run_benchmarks(args):
+    rng = np.random.default_rng(args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        dark_path, white_path, raw_paths, reflectance_paths, data = create_dataset(directory, args, rng)
+        processor = HSIProcessor()
+        n_images = len(reflectance_paths)
+        n_spectra = n_images * args.annotations
+
+        measurements = [processor.load_measurement(path)[0] for path in reflectance_paths]
+        cubes = [processor.measurement_2_arr(measurement) for measurement in measurements]
+        coordinates = [[details['coordinates'] for details in data[name].values()] for name in data]
+        spec_dict = hsi_analysis.add_spectra(data, kernel_size=args.kernel_size)
+
+        source_wavelengths = np.linspace(450, 950, args.bands)
+        resampler = SpectralResampler(np.arange(460, 941, 10))
+        feature_engine = FeatureEngine(source_wavelengths)
+
+        def bench_raw2reflectance():
+            processor.set_calibration(dark_path, white_path)
+            for path in raw_paths:
+                processor.raw2reflectance(processor.load_measurement(path)[1])
+
+        def bench_get_average_spectrum():
+            for hsi, points in zip(cubes, coordinates):
+                for point in points:
+                    hsi_analysis.get_average_spectrum(hsi, point, kernel_size=args.kernel_size)
+
+        stages = {
+            'load_measurement': (lambda: [processor.load_measurement(path) for path in reflectance_paths],
+                                 n_images, 'cubes/s'),
+            'measurement_2_arr': (lambda: [processor.measurement_2_arr(m) for m in measurements],
+                                  n_images, 'cubes/s'),
+            'measurement_2_arr_float32': (lambda: [processor.measurement_2_arr(m, dtype=np.float32)
+                                                   for m in measurements], n_images, 'cubes/s'),
+            'raw2reflectance': (bench_raw2reflectance, n_images, 'cubes/s'),
+            'raw2reflectance_numpy': (lambda: list(processor.raw2reflectance_batch(raw_paths, dark_path, white_path,
+                                                                                   engine='numpy')),
+                                      n_images, 'cubes/s'),
+            'resample_cube': (lambda: [resampler.resample_cube(hsi, source_wavelengths) for hsi in cubes],
+                              n_images, 'cubes/s'),
+            'feature_maps': (lambda: [feature_engine.compute(hsi) for hsi in cubes], n_images, 'cubes/s'),
+            'get_average_spectrum': (bench_get_average_spectrum, n_spectra, 'spectra/s'),
+            'get_average_spectra': (lambda: [hsi_analysis.get_average_spectra(hsi, points, kernel_size=args.kernel_size)
+                                             for hsi, points in zip(cubes, coordinates)], n_spectra, 'spectra/s'),
+            'extract_spectra': (lambda: hsi_analysis.extract_spectra(data, kernel_size=args.kernel_size,
+                                                                     workers=args.workers),
+                                n_spectra, 'spectra/s'),
+            'dict2dataframe': (lambda: hsi_analysis.dict2dataframe(spec_dict), n_spectra, 'spectra/s'),
+        }
+
+        for name, (function, items, unit) in stages.items():
+            if args.stages and name not in args.stages:
+                continue
+            seconds, peak = measure(function, args.repeat)
+            results[name] = {'seconds': seconds, 'throughput': items / seconds, 'unit': unit, 'peak_bytes': peak}
+            print(f"{name:28s} {items / seconds:12.1f} {unit:10s} {seconds * 1000:10.1f} ms "
+                  f"{peak / 1024 ** 2:10.1f} MiB peak")
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+
+    print(f"\nCompared to {baseline_path} ({baseline['meta'].get('commit')}):")
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        speedup = result['throughput'] / previous['throughput']
+        memory = result['peak_bytes'] / max(previous['peak_bytes'], 1)
+        print(f"{name:28s} {speedup:8.2f}x throughput {memory:8.2f}x peak memory")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--height', type=int, default=275)
+    parser.add_argument('--width', type=int, default=290)
+    parser.add_argument('--bands', type=int, default=51)
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--annotations', type=int, default=8, help='Annotations per image')
+    parser.add_argument('--kernel-size', type=int, default=7)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='*', help='Only run these stages')
+    parser.add_argument('--output', help='Write the results as JSON to this path')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+
+    report = {'meta': {'commit': git_commit(), 'python': platform.python_version(), 'numpy': np.__version__,
+                       'platform': platform.platform(), 'config': vars(args)},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
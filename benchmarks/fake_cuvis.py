@@ -0,0 +1,85 @@
+"""
+Minimal stand-in for the parts of the cuvis SDK used by HSIProcessor.
+
+Sessions are .npz files holding a 'cube' array, the name of its processing 'mode' and optionally the
+'wavelength' of every band. They can be written with save_session. Processing contexts compute reflectance in 1/10000 like the SDK.
+"""
+import enum
+
+import numpy as np
+
+
+class ProcessingMode(enum.Enum):
+    Raw = 0
+    DarkSubtract = 1
+    Reflectance = 2
+    SpectralRadiance = 3
+
+
+class ReferenceType(enum.Enum):
+    Dark = 0
+    White = 1
+    WhiteDark = 2
+    SpRad = 3
+    Distance = 4
+
+
+class ImageData:
+    def __init__(self, array, wavelength=None):
+        self.array = array
+        self.wavelength = [] if wavelength is None else [int(w) for w in wavelength]
+
+
+class Measurement:
+    def __init__(self, cube, processing_mode, wavelength=None):
+        self.data = {"cube": ImageData(cube, wavelength)}
+        self.processing_mode = processing_mode
+        self._handle = 1
+
+
+class SessionFile:
+    def __init__(self, path):
+        with np.load(path) as data:
+            wavelength = data['wavelength'] if 'wavelength' in data else None
+            self._measurements = [Measurement(data['cube'], ProcessingMode[str(data['mode'])], wavelength)]
+
+    def __getitem__(self, index):
+        return self._measurements[index]
+
+    def __len__(self):
+        return len(self._measurements)
+
+
+class ProcessingArgs:
+    def __init__(self):
+        self.processing_mode = ProcessingMode.Raw
+
+
+class ProcessingContext:
+    def __init__(self, session):
+        self._references = {}
+        self._args = ProcessingArgs()
+
+    def set_reference(self, measurement, reference_type):
+        self._references[reference_type] = measurement.data["cube"].array.astype(np.float32)
+
+    def set_processing_args(self, args):
+        self._args = args
+
+    def apply(self, measurement):
+        raw = measurement.data["cube"].array.astype(np.float32)
+        dark = self._references[ReferenceType.Dark]
+        white = self._references[ReferenceType.White]
+
+        reflectance = (raw - dark) / np.maximum(white - dark, 1) * 10000
+        return Measurement(np.clip(reflectance, 0, 65535).astype(np.uint16), ProcessingMode.Reflectance,
+                           measurement.data["cube"].wavelength)
+
+
+def save_session(path, cube, mode='Raw', wavelength=None):
+    # Written through a file handle, so np.savez keeps the .cu3s name
+    arrays = {'cube': cube, 'mode': mode}
+    if wavelength is not None:
+        arrays['wavelength'] = np.asarray(wavelength)
+    with open(path, 'wb') as session_file:
+        np.savez(session_file, **arrays)
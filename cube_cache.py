@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+
+class CubeCache:
+    """
+    On-disk cache of decoded cubes stored as uncompressed .npy files.
+
+    Entries are keyed by the absolute source path, its mtime and size and the processing
+    variant, so an edited or replaced .cu3s file is never served from a stale entry.
+    Cached cubes are memory-mapped read-only on load. The total size of the cache is
+    bounded by max_bytes, the least recently used entries are evicted first.
+
+    The directory is scanned once on creation, afterwards the entries and their total size
+    are tracked in memory. Temporary files older than stale_tmp_seconds are left over from
+    interrupted writes and are removed by the scan.
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 1024 ** 3, stale_tmp_seconds=3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stale_tmp_seconds = stale_tmp_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._entries = {npy_path: (mtime, size) for mtime, size, npy_path in self.entries()}
+        self._total = sum(size for _, size in self._entries.values())
+
+    def key(self, source_path, variant='native'):
+        stat = os.stat(source_path)
+        identity = f"{os.path.abspath(source_path)}|{stat.st_mtime_ns}|{stat.st_size}|{variant}"
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def _entry_paths(self, key):
+        return os.path.join(self.cache_dir, key + '.npy'), os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, source_path, variant='native'):
+        """
+        :return: Tuple of the memory-mapped cube and its metadata, or None on a cache miss.
+        """
+        npy_path, meta_path = self._entry_paths(self.key(source_path, variant))
+        try:
+            cube = np.load(npy_path, mmap_mode='r')
+            with open(meta_path, 'r') as meta_file:
+                meta = json.load(meta_file)
+            # Touching the entry marks it as recently used for the eviction
+            os.utime(npy_path)
+        except (OSError, ValueError):
+            return None
+
+        with self._lock:
+            if npy_path in self._entries:
+                self._entries[npy_path] = (time.time(), self._entries[npy_path][1])
+
+        return cube, meta
+
+    def put(self, source_path, cube, meta=None, variant='native'):
+        npy_path, meta_path = self._entry_paths(self.key(source_path, variant))
+
+        # Write to temporary files first, so parallel workers never read a half written entry
+        suffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(meta_path + suffix, 'w') as meta_file:
+            json.dump(meta or {}, meta_file)
+        os.replace(meta_path + suffix, meta_path)
+
+        with open(npy_path + suffix, 'wb') as npy_file:
+            np.save(npy_file, np.ascontiguousarray(cube))
+        os.replace(npy_path + suffix, npy_path)
+
+        size = os.path.getsize(npy_path)
+        with self._lock:
+            # An entry written again replaces the old one in the total
+            self._total += size - self._entries.get(npy_path, (0, 0))[1]
+            self._entries[npy_path] = (time.time(), size)
+
+        self.evict()
+
+    def entries(self):
+        """
+        Scans the cache directory and removes stale temporary files.
+
+        :return: List of (mtime, size, npy_path) of the cached cubes.
+        """
+        entries = []
+        stale = time.time() - self.stale_tmp_seconds
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith('.tmp'):
+                    try:
+                        if entry.stat().st_mtime < stale:
+                            os.remove(entry.path)
+                    except OSError:
+                        pass  # Renamed or removed by its writer in the meantime
+        return entries
+
+    def size(self):
+        return self._total
+
+    def evict(self):
+        with self._lock:
+            if self._total <= self.max_bytes:
+                return
+            entries = sorted((mtime, size, npy_path) for npy_path, (mtime, size) in self._entries.items())
+
+            for _, size, npy_path in entries:
+                if self._total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(npy_path)
+                except FileNotFoundError:
+                    pass  # Removed by another worker
+                except OSError:
+                    continue  # Entry is still memory-mapped somewhere (Windows)
+                try:
+                    os.remove(npy_path[:-len('.npy')] + '.json')
+                except OSError:
+                    pass
+                del self._entries[npy_path]
+                self._total -= size
+
+    def clear(self):
+        with self._lock:
+            for _, _, npy_path in self.entries():
+                for path in (npy_path, npy_path[:-len('.npy')] + '.json'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self._entries = {npy_path: (mtime, size) for mtime, size, npy_path in self.entries()}
+            self._total = sum(size for _, size in self._entries.values())
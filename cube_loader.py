@@ -0,0 +1,73 @@
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from hsi_processor import HSIProcessor
+
+
+LoadResult = namedtuple('LoadResult', ['path', 'cube', 'error'])
+
+EXECUTORS = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}
+
+
+def _load_worker(path, processor_kwargs):
+    # Runs inside the pool, cuvis objects never leave the worker, only the decoded array does
+    processor = HSIProcessor(**processor_kwargs)
+    return processor.load_array(path)
+
+
+def _collect(path, future):
+    try:
+        return LoadResult(path, future.result(), None)
+    except Exception as e:
+        print(f"Failed to load {path}: {e}")
+        return LoadResult(path, None, e)
+
+
+def iter_cubes(file_list, workers=None, mode='thread', processor_kwargs=None, max_pending=None):
+    """
+    Decodes .cu3s files with a thread or process pool and yields the cubes in input order.
+
+    At most max_pending files are decoded ahead of the consumer, so memory stays bounded
+    even for long file lists.
+
+    :param file_list: Paths of the .cu3s files to load.
+    :param workers: Number of workers, defaults to the number of CPUs. 1 loads in the calling thread.
+    :param mode: 'thread' or 'process'.
+    :param processor_kwargs: Keyword arguments used to create the HSIProcessor of each worker.
+    :param max_pending: Number of files decoded ahead of the consumer, defaults to 2 * workers.
+    :return: Generator of LoadResult(path, cube, error), error is None if the file was loaded.
+    """
+    if mode not in EXECUTORS:
+        raise ValueError(f"Unknown loader mode '{mode}', expected one of {list(EXECUTORS)}")
+
+    processor_kwargs = processor_kwargs or {}
+    workers = workers or os.cpu_count() or 1
+
+    if workers <= 1:
+        processor = HSIProcessor(**processor_kwargs)
+        for path in file_list:
+            try:
+                yield LoadResult(path, processor.load_array(path), None)
+            except Exception as e:
+                print(f"Failed to load {path}: {e}")
+                yield LoadResult(path, None, e)
+        return
+
+    max_pending = max_pending or 2 * workers
+    executor = EXECUTORS[mode](max_workers=workers)
+    pending = deque()
+    try:
+        for path in file_list:
+            pending.append((path, executor.submit(_load_worker, path, processor_kwargs)))
+            if len(pending) >= max_pending:
+                yield _collect(*pending.popleft())
+
+        while pending:
+            yield _collect(*pending.popleft())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def load_cubes(file_list, workers=None, mode='thread', processor_kwargs=None):
+    return list(iter_cubes(file_list, workers=workers, mode=mode, processor_kwargs=processor_kwargs))
@@ -0,0 +1,110 @@
+import os
+import json
+from collections import namedtuple
+
+
+DiscoveryResult = namedtuple('DiscoveryResult', ['file_dict', 'file_list', 'files'])
+
+MANIFEST_VERSION = 1
+
+
+def _scan_directory(path):
+    subdirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir() and not entry.is_symlink():
+                subdirs.append(entry.name)
+            elif entry.name.endswith('.cu3s') and not entry.name.startswith('.') and entry.is_file():
+                stat = entry.stat()
+                files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+
+    subdirs.sort()
+    files.sort()
+    return subdirs, files
+
+
+def _load_manifest(manifest_path, base_dir):
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('base_dir') != os.path.abspath(base_dir):
+        return {}
+    return manifest['directories']
+
+
+def _save_manifest(manifest_path, base_dir, directories):
+    manifest = {'version': MANIFEST_VERSION, 'base_dir': os.path.abspath(base_dir), 'directories': directories}
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def discover_cu3s_files(base_dir, manifest_path=None):
+    """
+    Finds all .cu3s files below base_dir in one pass and groups them by patient and body part.
+
+    Files are grouped by the names of their parent directory (patient) and their directory
+    (body part). With a manifest_path the listing of every directory is persisted together with
+    the directory mtime. Later runs only stat unchanged directories instead of listing them again.
+    Files that are modified in place don't change the directory mtime, delete the manifest to
+    force a full rescan.
+
+    :param base_dir: Root directory of the image tree.
+    :param manifest_path: Optional path of the manifest file used for incremental discovery.
+    :return: DiscoveryResult with the patient/body part dictionary, the flat file list and
+             a dictionary mapping each path to its (size, mtime_ns).
+    """
+    previous = _load_manifest(manifest_path, base_dir) if manifest_path is not None else {}
+    directories = {}
+
+    file_dict = {}
+    file_list = []
+    files = {}
+
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        root = os.path.join(base_dir, rel_dir) if rel_dir else base_dir
+
+        try:
+            mtime_ns = os.stat(root).st_mtime_ns
+        except OSError:
+            continue
+
+        cached = previous.get(rel_dir)
+        if cached is not None and cached['mtime_ns'] == mtime_ns:
+            subdirs, dir_files = cached['subdirs'], cached['files']
+        else:
+            try:
+                subdirs, dir_files = _scan_directory(root)
+            except OSError:
+                continue
+
+        directories[rel_dir] = {'mtime_ns': mtime_ns, 'subdirs': subdirs, 'files': dir_files}
+
+        # Reversed, so the directories are visited in sorted order
+        stack.extend(os.path.join(rel_dir, subdir) for subdir in reversed(subdirs))
+
+        # Skip the root directory itself
+        if not rel_dir or not dir_files:
+            continue
+
+        parts = root.split(os.sep)
+        if len(parts) >= 3:
+            patient_name = parts[-2]
+            body_part = parts[-1]
+
+            paths = [os.path.join(root, name) for name, _, _ in dir_files]
+            file_dict.setdefault(patient_name, {}).setdefault(body_part, []).extend(paths)
+            file_list.extend(paths)
+            for path, (_, size, file_mtime_ns) in zip(paths, dir_files):
+                files[path] = (size, file_mtime_ns)
+
+    if manifest_path is not None:
+        _save_manifest(manifest_path, base_dir, directories)
+
+    return DiscoveryResult(file_dict, file_list, files)
@@ -1,83 +1,182 @@
 import csv
-import os
 import sys
 import json
-import glob
 
 import numpy as np
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-
-import umap
 
 from pathlib import Path
-from PyQt5.QtWidgets import QApplication
 
-from visualization.visualizer import HSIViewer
-from hsi_processor import HSIProcessor
+from visualization.annotation_writer import ANNOTATION_COLUMNS
+from hsi_processor import DEFAULT_WAVELENGTHS
+from cube_loader import iter_cubes
+from umap_sweep import umap_sweep
+from instrumentation import active as active_instrumentation
+from discovery import discover_cu3s_files
+from annotation_index import AnnotationIndex, ImagePathIndex
+from region_statistics import masks_to_labels, region_statistics
+from spectral_dataset import META_COLUMNS, SpectralDatasetWriter, read_spectral_dataset, iter_spectral_dataset
+from spectral_stats import DEFAULT_EDGES, GroupedSpectralStats, SpectrumAccumulator, plot_spectral_summary
+from spectral_features import FeatureEngine
+
 
+def create_UMAP(df, out_dir='umap_plots', workers=None):
+    """
+    Runs the UMAP sweep on the mean skin spectra per patient and body part.
+
+    :param out_dir: Directory the embeddings (.npy) and figures (.png) are saved to, relative to the working
+                    directory by default.
+    :return: Dictionary mapping (metric, n_neighbors, min_dist) to the embedding.
+    """
+    if out_dir is None:
+        raise ValueError("create_UMAP needs an out_dir to save the embeddings and figures to")
 
-def create_UMAP(df):
     df_ref = df
 
     df_ref = df_ref[df_ref['annotation_type'] == 'skin']
 
-    # Reshaping the DataFrame
-    reshaped_df = df_ref.pivot_table(index=['patient_id', 'body_part'], columns='wavelength',
-                                 values='reflectance').reset_index()
+    # Averaging the spectra per patient and body part directly on the wide DataFrame
+    reshaped_df = df_ref.groupby(['patient_id', 'body_part'], observed=True)[spectra_columns(df_ref)].mean().reset_index()
 
     # Extract features and target
     features = reshaped_df.drop(['body_part', 'patient_id'], axis=1).values
     body_parts = reshaped_df['body_part'].values
     #patient_ids = reshaped_df['patient_id'].values
 
-    for metric in ['correlation']:
-        for n in [5, 10, 20]:
-            for d in (0.1, 0.15, 0.25, 0.5, 0.8):
+    return umap_sweep(features, labels=body_parts, out_dir=out_dir, metrics=['correlation'], n_neighbors=[5, 10, 20],
+                      min_dists=(0.1, 0.15, 0.25, 0.5, 0.8), workers=workers, legend_title='Body part')
 
-                reducer = umap.UMAP(n_neighbors=n, min_dist=d, metric=metric)
-                embedding = reducer.fit_transform(features)
-                sns.set_theme(style="darkgrid")
-                # Plot
-                plt.figure(figsize=(10, 6))
-                for body_part in set(body_parts):
-                    indices = body_parts == body_part
-                    plt.scatter(embedding[indices, 0], embedding[indices, 1], label=body_part)
-                plt.title(f'UMAP plot with points colored by patient_id, metric={metric}, n={n},d={d}')
-                plt.legend(title='Body part', loc='upper left')
-                plt.show()
 
+def spectra_columns(df):
+    return [column for column in df.columns if column not in META_COLUMNS]
 
 
-def dict2dataframe(data_dict):
-    wavelengths = np.linspace(450, 950, 51)
-    wavelength_columns = [int(w) for w in wavelengths]
+def output_wavelengths(processor_kwargs=None):
+    # Spectra are on the target grid of the processor if it resamples, otherwise on the default grid
+    target_wavelengths = (processor_kwargs or {}).get('target_wavelengths')
+    return np.asarray(target_wavelengths, dtype=float) if target_wavelengths is not None else DEFAULT_WAVELENGTHS
+
 
-    # Preparing data for DataFrame
-    data_for_df = []
+def dict2arrays(data_dict, wavelengths=None):
+    """
+    Collects the annotated spectra of a data dictionary into one preallocated matrix.
+
+    :param data_dict: The dictionary containing the image data with reflectance values.
+    :param wavelengths: Wavelengths of the spectra, defaults to 450 - 950 nm in 51 bands.
+    :return: Tuple of a dictionary with one list per column of META_COLUMNS and the (N, bands) spectra.
+    """
+    if wavelengths is None:
+        wavelengths = DEFAULT_WAVELENGTHS
+
+    n_rows = sum(len(measurement) for measurement in data_dict.values())
+
+    # Spectra with fewer values than wavelengths are padded with NaN
+    spectra = np.full((n_rows, len(wavelengths)), np.nan)
+    meta = {column: [] for column in META_COLUMNS}
+
+    row = 0
     for measurement_name, measurement in data_dict.items():
         for item in measurement.values():
-            row = {
-                'image_name': measurement_name,
-                'patient_id': item['patient_id'],
-                'body_part': item['body_part'],
-                'annotation_type': item['annotation_type']
-            }
-            # Ensuring there are 51 reflectance values (padding with NaN if needed)
-            reflectance_values = item['reflectance']
-            row.update(dict(zip(wavelength_columns, reflectance_values)))
-            data_for_df.append(row)
-
-    # Creating the DataFrame
-    df = pd.DataFrame(data_for_df)
+            meta['image_name'].append(measurement_name)
+            meta['patient_id'].append(item['patient_id'])
+            meta['body_part'].append(item['body_part'])
+            meta['annotation_type'].append(item['annotation_type'])
+            meta['x'].append(item['coordinates'][0])
+            meta['y'].append(item['coordinates'][1])
+
+            reflectance_values = np.asarray(item['reflectance'])[:len(wavelengths)]
+            spectra[row, :len(reflectance_values)] = reflectance_values
+            row += 1
+
+    return meta, spectra
+
+
+def spectra2long(meta, spectra, wavelengths):
+    """
+    Builds the long form (one row per spectrum and wavelength) without a melt.
+
+    :param meta: DataFrame with one row per spectrum.
+    :param spectra: Array of shape (N, bands).
+    :param wavelengths: Wavelength of each band.
+    :return: DataFrame with the metadata columns, 'wavelength' and 'reflectance'.
+    """
+    n_rows, n_bands = spectra.shape
+
+    # Categorical columns only repeat their integer codes, the values are never expanded
+    columns = {}
+    for column in meta.columns:
+        if isinstance(meta[column].dtype, pd.CategoricalDtype):
+            columns[column] = pd.Categorical.from_codes(np.repeat(meta[column].cat.codes.to_numpy(), n_bands),
+                                                        dtype=meta[column].dtype)
+        else:
+            columns[column] = np.repeat(meta[column].to_numpy(), n_bands)
+    long_df = pd.DataFrame(columns)
+
+    long_df['wavelength'] = np.tile(np.asarray(wavelengths), n_rows)
+    long_df['reflectance'] = spectra.reshape(-1)
+
+    return long_df
+
+
+def wide2long(df):
+    columns = spectra_columns(df)
+    meta = df[[column for column in df.columns if column in META_COLUMNS]]
+    return spectra2long(meta, df[columns].to_numpy(), pd.to_numeric(pd.Index(columns)))
+
+
+def dict2dataframe(data_dict, long=False, wavelengths=None):
+    if wavelengths is None:
+        wavelengths = DEFAULT_WAVELENGTHS
+    wavelength_columns = [int(w) for w in wavelengths]
+
+    with active_instrumentation().stage('dataframe'):
+        meta, spectra = dict2arrays(data_dict, wavelengths)
+        meta_df = pd.DataFrame({column: pd.Categorical(meta[column])
+                                for column in ['image_name', 'patient_id', 'body_part', 'annotation_type']})
+
+        if long:
+            return spectra2long(meta_df, spectra, wavelength_columns)
+
+        # The spectra stay one contiguous block, the metadata columns are put in front of it
+        df = pd.DataFrame(spectra, columns=wavelength_columns, copy=False)
+        for position, column in enumerate(meta_df.columns):
+            df.insert(position, column, meta_df[column])
 
     return df
 
-def get_dataframe(spectra_array):
+
+def dict2dataset(data_dict, path, wavelengths=None):
+    """
+    Appends the annotated spectra of a data dictionary to a columnar spectral dataset.
+
+    :param data_dict: The dictionary containing the image data with reflectance values.
+    :param path: The dataset directory, created if it does not exist.
+    :param wavelengths: Wavelengths of the spectra, defaults to 450 - 950 nm in 51 bands.
+    """
+    if wavelengths is None:
+        wavelengths = DEFAULT_WAVELENGTHS
+
+    meta, spectra = dict2arrays(data_dict, wavelengths)
+    with active_instrumentation().stage('dataset_write'):
+        SpectralDatasetWriter(path, wavelengths).append(meta, spectra)
+
+
+def dataframe2dataset(df, path, wavelengths=None):
+    """
+    Appends a wide spectra DataFrame (as built by dict2dataframe) to a columnar spectral dataset.
+    Missing coordinate columns are stored as -1.
+    """
+    if wavelengths is None:
+        wavelengths = DEFAULT_WAVELENGTHS
+    wavelength_columns = [int(w) for w in wavelengths]
+
+    meta = {column: df[column].values if column in df else np.full(len(df), -1) for column in META_COLUMNS}
+    SpectralDatasetWriter(path, wavelengths).append(meta, df[wavelength_columns].to_numpy())
+
+def get_dataframe(spectra_array, wavelengths=None, edges=DEFAULT_EDGES):
 
     # Setting column names as wavelengths
-    column_names = np.linspace(450, 950, 51).astype(int).astype(str)
+    column_names = np.asarray(DEFAULT_WAVELENGTHS if wavelengths is None else wavelengths).astype(int).astype(str)
 
     df = pd.DataFrame(spectra_array, columns=column_names)
 
@@ -85,56 +184,215 @@ def get_dataframe(spectra_array):
     df.reset_index(inplace=True)
     df.rename(columns={'index': 'Measurement'}, inplace=True)
 
-    # Melt the DataFrame
-    df_melted = df.melt(id_vars='Measurement', var_name='Wavelength', value_name='Reflectance')
-
-    print(df_melted.head())
-
-    df_melted['Wavelength'] = pd.to_numeric(df_melted['Wavelength'])
+    # Mean and std per wavelength are computed once on the wide matrix instead of by seaborn on a melted frame
+    accumulator = SpectrumAccumulator(len(column_names), edges)
+    accumulator.update(spectra_array)
+    summary = pd.DataFrame({'wavelength': column_names.astype(int), 'mean': accumulator.mean, 'std': accumulator.std()})
 
-    print(df_melted.head())
+    print(summary.head())
 
     # Plotting
-    sns.set_theme(style="darkgrid")
-
-    sns.lineplot(data=df_melted, x='Wavelength', y='Reflectance', errorbar='sd')
-    plt.xlabel('Wavelength (nm)')
-    plt.ylabel('Reflectance')
-    plt.title('Reflectance over Wavelength')
+    import matplotlib.pyplot as plt
+    plot_spectral_summary(summary, hue=None, title='Reflectance over Wavelength')
     plt.show()
 
     return df
 
-def add_spectra(data, kernel_size=3):
-    processor = HSIProcessor()
+
+def grouped_spectral_statistics(source, group_by=('annotation_type',), chunk_rows=100000, edges=DEFAULT_EDGES):
+    """
+    Computes per-group mean, std and quantiles per wavelength with mergeable streaming accumulators.
+
+    :param source: Wide spectra DataFrame, path of a spectral dataset or list of dataset paths.
+    :param group_by: Metadata columns defining the groups, e.g. ('annotation_type', 'body_part', 'patient_id').
+    :param chunk_rows: Number of DataFrame rows processed at once, datasets are processed part by part.
+    :param edges: Histogram bin edges of the quantiles, must cover the range of the spectra (reflectance by default).
+    :return: GroupedSpectralStats, call summary() for a DataFrame or plot it with plot_spectral_summary.
+    """
+    if isinstance(source, pd.DataFrame):
+        columns = spectra_columns(source)
+        stats = GroupedSpectralStats(pd.to_numeric(pd.Index(columns)), group_by=group_by, edges=edges)
+        for start in range(0, len(source), chunk_rows):
+            stats.update_dataframe(source.iloc[start:start + chunk_rows], columns)
+        return stats
+
+    stats = None
+    for path in [source] if isinstance(source, str) else source:
+        for meta, spectra, wavelengths in iter_spectral_dataset(path):
+            if stats is None:
+                stats = GroupedSpectralStats(wavelengths, group_by=group_by, edges=edges)
+            stats.update(meta, spectra)
+
+    return stats
+
+
+def group_annotations_by_image(data):
+    """
+    Groups the annotations of a data dictionary by the image file they refer to.
+
+    :param data: The dictionary containing the image data.
+    :return: A dictionary mapping each image path to a list of (image_name, annotation_number, details).
+    """
+    grouped = {}
 
     for image_name, annotations in data.items():
         for annotation_number, details in annotations.items():
-            measurement, _ = processor.load_measurement(details['image_path'])
-            hsi = processor.measurement_2_arr(measurement)
-            details['reflectance'] = get_average_spectrum(hsi, coordinates=details['coordinates'], kernel_size=kernel_size)
+            grouped.setdefault(details['image_path'], []).append((image_name, annotation_number, details))
 
-    return data
+    return grouped
+
+
+def get_annotation_spectra(hsi, annotations, kernel_size, image_path):
+    """
+    Average spectra of the annotations of one image. Annotations whose kernel lies outside of the image
+    are reported and get NaN spectra, the rest of the image is kept.
+
+    :param annotations: List of (image_name, annotation_number, details) of the image.
+    :return: Tuple of the (N, bands) spectra and the boolean mask of the annotations inside the image.
+    """
+    coordinates = np.asarray([details['coordinates'] for _, _, details in annotations], dtype=np.intp).reshape(-1, 2)
+    inside = kernels_inside(hsi.shape, coordinates, kernel_size)
+    for (image_name, annotation_number, details), valid in zip(annotations, inside):
+        if not valid:
+            print(f"Annotation {annotation_number} of {image_name} at {details['coordinates']} "
+                  f"is outside of {image_path}")
+
+    spectra = np.full((len(annotations), hsi.shape[2]), np.nan)
+    if inside.any():
+        spectra[inside] = get_average_spectra(hsi, coordinates[inside], kernel_size=kernel_size)
+    return spectra, inside
 
 
-def extract_spectra(data, kernel_size=3):
+def iter_image_spectra(data, kernel_size=3, workers=1, mode='thread', processor_kwargs=None, skip_images=()):
+    """
+    Decodes every annotated image once and yields the spectra of all its annotations.
+
+    :param skip_images: Image paths that are not processed, e.g. because a previous run finished them.
+    :return: Generator of (image_path, annotations, spectra), spectra is None if the image failed to load.
+             Annotations whose kernel lies outside of the image get NaN spectra.
+    """
+    grouped = group_annotations_by_image(data)
+    image_paths = [image_path for image_path in grouped if image_path not in skip_images]
+
+    instrumentation = active_instrumentation()
+
+    for image_path, hsi, error in iter_cubes(image_paths, workers=workers, mode=mode, processor_kwargs=processor_kwargs):
+        annotations = grouped[image_path]
+        if error is not None:
+            yield image_path, annotations, None
+            continue
+
+        try:
+            with instrumentation.stage('spectrum_extraction'):
+                spectra, inside = get_annotation_spectra(hsi, annotations, kernel_size, image_path)
+        except Exception as e:
+            print(f"Failed to extract spectra from {image_path}: {e}")
+            yield image_path, annotations, None
+            continue
+        instrumentation.count('spectra_extracted', int(inside.sum()))
+
+        yield image_path, annotations, spectra
 
-    processor = HSIProcessor()
-    spectra_arr = np.zeros(shape=(len(data), 51))
 
-    i = 0
+def iter_spectra(data, kernel_size=3, workers=1, mode='thread', processor_kwargs=None, skip_images=()):
+    """
+    Streams (image_name, annotation_number, details, spectrum) records as the images are processed.
+    Annotations of images that fail to load get NaN spectra.
+    """
+    for image_path, annotations, spectra in iter_image_spectra(data, kernel_size, workers, mode, processor_kwargs,
+                                                               skip_images):
+        if spectra is None:
+            spectra = np.full((len(annotations), len(output_wavelengths(processor_kwargs))), np.nan)
+
+        for (image_name, annotation_number, details), spectrum in zip(annotations, spectra):
+            yield image_name, annotation_number, details, spectrum
+
+
+def add_spectra(data, kernel_size=3, workers=1, mode='thread', processor_kwargs=None):
+
+    for image_name, annotation_number, details, spectrum in iter_spectra(data, kernel_size, workers, mode,
+                                                                         processor_kwargs):
+        details['reflectance'] = spectrum
+
+    return data
+
+
+def extract_spectra(data, kernel_size=3, workers=1, mode='thread', processor_kwargs=None):
+
+    # Remember the position of each annotation so the output keeps the order of data
+    positions = {}
     for image_name, annotations in data.items():
-        for annotation_number, details in annotations.items():
+        for annotation_number in annotations:
+            positions[(image_name, annotation_number)] = len(positions)
 
-            measurement, _ = processor.load_measurement(details['image_path'])
-            hsi = processor.measurement_2_arr(measurement)
+    spectra_arr = np.full(shape=(len(positions), len(output_wavelengths(processor_kwargs))), fill_value=np.nan)
 
-            spectra_arr[i,:] = get_average_spectrum(hsi, coordinates=details['coordinates'], kernel_size=kernel_size)
-            i += 1
+    for image_name, annotation_number, details, spectrum in iter_spectra(data, kernel_size, workers, mode,
+                                                                         processor_kwargs):
+        spectra_arr[positions[(image_name, annotation_number)], :] = spectrum
 
     return spectra_arr
 
 
+def extract_spectra_to_dataset(data, path, kernel_size=3, chunk_size=1000, workers=1, mode='thread',
+                               processor_kwargs=None):
+    """
+    Extracts the annotated spectra and appends them to a spectral dataset in chunks.
+
+    Every chunk records the images it completed, so a restarted run skips the images that are
+    already in the dataset. Images that fail to load are not recorded and are retried on the next run.
+    Annotations outside of their image are reported and stored with NaN spectra.
+    Only one chunk of spectra is held in memory, data is not modified.
+
+    :param data: The dictionary containing the image data.
+    :param path: The dataset directory, created if it does not exist.
+    :param chunk_size: Minimum number of spectra written per chunk.
+    :return: Number of spectra written by this run.
+    """
+    wavelengths = output_wavelengths(processor_kwargs)
+    writer = SpectralDatasetWriter(path, wavelengths)
+
+    meta = {column: [] for column in META_COLUMNS}
+    spectra = []
+    sources = []
+    written = 0
+
+    def flush():
+        nonlocal meta, spectra, sources, written
+        if sources:
+            chunk = np.concatenate(spectra)
+            with active_instrumentation().stage('dataset_write'):
+                writer.append(meta, chunk, sources=sources)
+            written += len(chunk)
+            print(f"Wrote {written} spectra, {len(writer.completed_sources())} images done")
+        meta = {column: [] for column in META_COLUMNS}
+        spectra = []
+        sources = []
+
+    for image_path, annotations, image_spectra in iter_image_spectra(data, kernel_size, workers, mode,
+                                                                     processor_kwargs,
+                                                                     skip_images=writer.completed_sources()):
+        if image_spectra is None:
+            continue
+
+        for image_name, annotation_number, details in annotations:
+            meta['image_name'].append(image_name)
+            meta['patient_id'].append(details['patient_id'])
+            meta['body_part'].append(details['body_part'])
+            meta['annotation_type'].append(details['annotation_type'])
+            meta['x'].append(details['coordinates'][0])
+            meta['y'].append(details['coordinates'][1])
+        spectra.append(image_spectra)
+        sources.append(image_path)
+
+        if sum(len(image_spectra) for image_spectra in spectra) >= chunk_size:
+            flush()
+
+    flush()
+
+    return written
+
+
 def filter_images(data, key1=None, value1=None, key2=None, value2=None):
     """
     Filters images based on up to two optional criteria in the dictionary, maintaining the original structure.
@@ -145,56 +403,167 @@ def filter_images(data, key1=None, value1=None, key2=None, value2=None):
     :param key2: The second key to filter on (e.g., 'body_part'), optional.
     :param value2: The specific value of the second key to filter on, optional.
     :return: A dictionary of filtered image data.
+
+    For repeated or multi-key queries build an AnnotationIndex once and query it directly.
     """
-    filtered_data = {}
+    criteria = {}
+    if key1 is not None:
+        criteria[key1] = value1
+    if key2 is not None:
+        criteria[key2] = value2
 
-    for image_name, annotations in data.items():
-        for annotation_number, details in annotations.items():
-            match1 = details.get(key1) == value1 if key1 is not None else True
-            match2 = details.get(key2) == value2 if key2 is not None else True
+    return AnnotationIndex.from_data(data).filter(**criteria)
+
+def kernels_inside(shape, coordinates, kernel_size=1):
+    """
+    :return: Boolean array, True for the (x, y) coordinates whose kernel overlaps an image of the given shape.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.intp).reshape(-1, 2)
+    height, width = shape[:2]
+    distance = int(kernel_size/2) if kernel_size > 1 else 0
+
+    return ((coordinates[:, 0] + distance >= 0) & (coordinates[:, 0] - distance < width) &
+            (coordinates[:, 1] + distance >= 0) & (coordinates[:, 1] - distance < height))
+
+
+def get_average_spectra(hsi, coordinates, kernel_size=1):
+    """
+    Computes the average spectra around several (x, y) coordinates in one vectorized pass.
+
+    Kernels reaching over the image border are clipped to the image, so only the pixels
+    inside the image contribute to the average.
+
+    :param hsi: The hyperspectral cube with shape (height, width, bands).
+    :param coordinates: Array-like of N (x, y) coordinates.
+    :param kernel_size: Edge length of the square averaging kernel.
+    :return: An array of shape (N, bands) holding one spectrum per coordinate.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.intp).reshape(-1, 2)
+    height, width = hsi.shape[:2]
 
-            if match1 and match2:
-                if image_name not in filtered_data:
-                    filtered_data[image_name] = {}
-                filtered_data[image_name][annotation_number] = details
+    distance = int(kernel_size/2) if kernel_size > 1 else 0
+    offsets = np.arange(-distance, distance + 1)
+
+    rows = coordinates[:, 1, None] + offsets
+    cols = coordinates[:, 0, None] + offsets
+    row_valid = (rows >= 0) & (rows < height)
+    col_valid = (cols >= 0) & (cols < width)
+
+    outside = ~kernels_inside(hsi.shape, coordinates, kernel_size)
+    if np.any(outside):
+        raise ValueError(f"Coordinates outside of the image: {coordinates[outside].tolist()}")
+
+    # Gather all kernels at once as (N, k, k, bands), clipped indices are masked out below
+    windows = hsi[np.clip(rows, 0, height - 1)[:, :, None], np.clip(cols, 0, width - 1)[:, None, :], :]
+
+    weights = (row_valid[:, :, None] & col_valid[:, None, :]).astype(np.result_type(windows.dtype, np.float32))
+    sums = np.einsum('nij,nijb->nb', weights, windows)
+
+    return sums / weights.sum(axis=(1, 2))[:, None]
 
-    return filtered_data
 
 def get_average_spectrum(hsi, coordinates, kernel_size=1):
+    return get_average_spectra(hsi, [coordinates], kernel_size=kernel_size)[0]
+
+
+def extract_region_statistics(masks_by_image, percentiles=(25, 50, 75), workers=1, mode='thread',
+                              processor_kwargs=None):
+    """
+    Computes spectral statistics over region masks (rectangles, polygons, brush strokes, lesion outlines).
+    Every image is decoded once and all of its regions are reduced in one vectorized pass.
+
+    :param masks_by_image: Dictionary mapping image paths to a list of boolean masks.
+    :param percentiles: Percentiles computed per region and band.
+    :return: Dictionary mapping image paths to the output of region_statistics, one row per mask.
+    """
+    results = {}
+    for image_path, hsi, error in iter_cubes(list(masks_by_image), workers=workers, mode=mode,
+                                             processor_kwargs=processor_kwargs):
+        if error is not None:
+            continue
+
+        masks = masks_by_image[image_path]
+        with active_instrumentation().stage('region_statistics'):
+            results[image_path] = region_statistics(hsi, masks_to_labels(masks), percentiles=percentiles,
+                                                    n_regions=len(masks))
+
+    return results
+
+
+def extract_feature_values(data, features=None, kernel_size=3, workers=1, mode='thread', processor_kwargs=None):
+    """
+    Computes spectral feature maps (ratios, indices, band depths, ...) of every annotated image and averages
+    them in the kernel around each annotation.
+
+    :param data: The dictionary containing the image data.
+    :param features: Dictionary of spectral_features.Feature, defaults to the spectral_features.DEFAULT_FEATURES
+                     covered by the wavelengths of the processor.
+    :return: DataFrame with the META_COLUMNS and one column per feature. Annotations whose kernel lies
+             outside of their image get NaN feature values.
+    """
+    engine = FeatureEngine(output_wavelengths(processor_kwargs), features=features)
+    if engine.unavailable:
+        print(f"Features not covered by the wavelengths: {engine.unavailable}")
+    grouped = group_annotations_by_image(data)
+
+    meta = {column: [] for column in META_COLUMNS}
+    values = []
+    for image_path, hsi, error in iter_cubes(list(grouped), workers=workers, mode=mode,
+                                             processor_kwargs=processor_kwargs):
+        if error is not None:
+            continue
 
-    distance = int(kernel_size/2)
+        annotations = grouped[image_path]
+        with active_instrumentation().stage('feature_maps'):
+            names, stack = engine.compute_stack(hsi)
+        # Annotations outside of the image get NaN feature values
+        values.append(get_annotation_spectra(stack, annotations, kernel_size, image_path)[0])
+
+        for image_name, annotation_number, details in annotations:
+            meta['image_name'].append(image_name)
+            meta['patient_id'].append(details['patient_id'])
+            meta['body_part'].append(details['body_part'])
+            meta['annotation_type'].append(details['annotation_type'])
+            meta['x'].append(details['coordinates'][0])
+            meta['y'].append(details['coordinates'][1])
+
+    values = np.concatenate(values) if values else np.empty((0, len(engine.features)))
+    df = pd.DataFrame(meta)
+    for i, name in enumerate(engine.names()):
+        df[name] = values[:, i]
 
-    if kernel_size <= 1:
-        avg_spectrum = hsi[coordinates[1], coordinates[0], :]
-    else:
-        area_pixel = hsi[coordinates[1]-distance:coordinates[1]+distance+1,
-                           coordinates[0]-distance:coordinates[0]+distance+1, :]
-        avg_spectrum = np.mean(area_pixel, axis=(0,1))
+    return df
 
-    return avg_spectrum
 
 def read_annotations(csv_path):
     annotations = []
     with open(csv_path, 'r') as csv_file:
         reader = csv.reader(csv_file)
         for row in reader:
+            if row and row[0] == ANNOTATION_COLUMNS[0]:
+                continue  # Header of files written by the viewer
             annotations.append(row)
 
     return annotations
 
 
 def map_annotations_to_images(hsi_dic, annotation_list):
+    """
+    Maps annotations to the paths of their images.
 
+    Annotations whose image isn't found, including unknown patients and body parts, are kept with
+    an image_path of None and reported once per image name, instead of raising a KeyError.
+    """
     data_dict = {}
+    image_index = ImagePathIndex(hsi_dic)
+    unmapped = set()
 
     for annotation in annotation_list:
 
-        image_paths = hsi_dic[annotation[5]][annotation[4]]
-        mapped_image = None
-
-        for path in image_paths:
-            if annotation[0] in path:
-                mapped_image = path
+        mapped_image = image_index.resolve(annotation[0], annotation[5], annotation[4])
+        if mapped_image is None and annotation[0] not in unmapped:
+            unmapped.add(annotation[0])
+            print(f"No image found for {annotation[0]} of patient {annotation[5]}, {annotation[4]}")
 
         annotation_dict = {'image_path': mapped_image,
                            'patient_id': annotation[5],
@@ -215,35 +584,22 @@ def save_json(dict, path):
         json.dump(dict, json_file)
 
 
-def group_cu3s_files(base_dir):
-    file_dict = {}
-
-    # Walk through the directory
-    for root, dirs, files in os.walk(base_dir):
-        # Skip the root directory itself
-        if root == base_dir:
-            continue
-
-        # Extract patient name and body part from the path
-        parts = root.split(os.sep)
-        if len(parts) >= 3:
-            patient_name = parts[-2]
-            body_part = parts[-1]
-
-            # Find all .cu3s files in the current directory
-            cu3s_files = glob.glob(os.path.join(root, '*.cu3s'))
-
-            # Add to dictionary
-            if cu3s_files:
-                file_dict.setdefault(patient_name, {}).setdefault(body_part, []).extend(cu3s_files)
-
-    return file_dict
+def group_cu3s_files(base_dir, manifest_path=None):
+    return discover_cu3s_files(base_dir, manifest_path=manifest_path).file_dict
 
 
-def read_dataframe(xlsx_path):
+def read_dataframe(path, coordinates=False):
 
-    df = pd.read_excel(xlsx_path)
-    df = df[df.columns[1:]]
+    with active_instrumentation().stage('dataframe_read'):
+        if path.endswith(('.xlsx', '.xls')):
+            df = pd.read_excel(path)
+            df = df[df.columns[1:]]
+        else:
+            # Columnar spectral dataset directory
+            meta, spectra, wavelengths = read_spectral_dataset(path)
+            if not coordinates:
+                meta = meta.drop(columns=['x', 'y'])
+            df = pd.concat([meta, pd.DataFrame(spectra, columns=[int(w) for w in wavelengths])], axis=1)
 
     print(df.head())
 
@@ -254,6 +610,8 @@ def read_dataframe(xlsx_path):
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     image_dir = "C:\\Users\\C140_Martin\\Desktop\\hsi_test_data\\images"
     annotation_file = "C:\\Users\\C140_Martin\\development\\hsi_preprocessing\\resources\\point_annotations.csv"
     """
@@ -270,33 +628,23 @@ if __name__ == "__main__":
 
     """
 
-    #df.to_excel("C:\\Users\\C140_Martin\\development\\hsi_preprocessing\\resources\\dataframe_k7.xlsx")
-    df = read_dataframe("C:\\Users\\C140_Martin\\development\\hsi_preprocessing\\resources\\dataframe_k7.xlsx")
+    #dict2dataset(spec_dict, "C:\\Users\\C140_Martin\\development\\hsi_preprocessing\\resources\\dataset_k7")
+    dataframe_path = "C:\\Users\\C140_Martin\\development\\hsi_preprocessing\\resources\\dataframe_k7.xlsx"
+    dataset_path = "C:\\Users\\C140_Martin\\development\\hsi_preprocessing\\resources\\dataset_k7"
+    if not Path(dataset_path).is_dir():
+        # One-time conversion of the existing Excel export to the columnar dataset
+        dataframe2dataset(read_dataframe(dataframe_path), dataset_path)
+    df = read_dataframe(dataset_path)
 
     #df = df[df['body_part'] == 'arms']
     #df = df[df['annotation_type'] == 'lesion']
 
-    # Melt the DataFrame to have 'wavelength' and 'reflectance' columns
-    df_melted = df.melt(id_vars=['image_name', 'patient_id', 'body_part', 'annotation_type'],
-                        var_name='wavelength',
-                        value_name='reflectance')
+    # Grouped mean and std per wavelength, computed on the wide table without melting it
+    stats = grouped_spectral_statistics(df, group_by=['annotation_type'])
+    summary = stats.summary()
 
-    # Convert wavelength to numeric if it's not already
-    df_melted['wavelength'] = pd.to_numeric(df_melted['wavelength'])
-
-    print(df_melted.head())
-    #df_melted = df_melted[df_melted['annotation_type'] == 'skin']
-
-    # Now you can plot using Seaborn
-
-    sns.set_theme(style="darkgrid")
+    print(summary.head())
 
     # Example to plot error lines for 'lesion' annotation_type
-    plt.figure(figsize=(14, 7))
-    sns.lineplot(x='wavelength', y='reflectance',hue='annotation_type', data=df_melted, errorbar='sd')
-
-    plt.xlabel('Wavelength (nm)')
-    plt.ylabel('Reflectance')
-    plt.title('Reflectance over wavelength of normal skin')
-    plt.legend()
+    plot_spectral_summary(summary, hue='annotation_type', title='Reflectance over wavelength of normal skin')
     plt.show()
@@ -4,67 +4,216 @@ import platform
 import cuvis
 
 import sys
+import time
 import numpy as np
-import matplotlib.pyplot as plt
+
+from cube_cache import CubeCache
+from reflectance import ReflectanceCalibrator
+from instrumentation import active as active_instrumentation
+from spectral_resampling import SpectralResampler
+
+
+# Band centres of the cubes when a measurement doesn't provide its own wavelengths
+DEFAULT_WAVELENGTHS = np.linspace(450, 950, 51)
+
+
+class ScaledCube:
+    """
+    Read-only integer cube with its scale factor carried alongside.
+
+    Indexing returns the scaled values in the requested float dtype, so only the pixels that
+    are actually accessed get converted instead of the whole cube.
+    """
+
+    def __init__(self, array, scale, dtype=np.float32):
+        self.array = array
+        self.scale = scale
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, key):
+        return np.multiply(self.array[key], self.scale, dtype=self.dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        scaled = self[...]
+        return scaled if dtype is None else scaled.astype(dtype)
 
 
 class HSIProcessor:
-    def __init__(self):
-        self.wavelengths = np.linspace(450, 950, 51)
+    def __init__(self, cache_dir=None, cache_max_bytes=20 * 1024 ** 3, dtype=None, lazy_scale=False,
+                 target_wavelengths=None):
+        self._references = {}
+
+        # Output format of load_array, see measurement_2_arr
+        self.dtype = dtype
+        self.lazy_scale = lazy_scale
+
+        # With target wavelengths load_array maps every cube from its own wavelengths onto this grid
+        if target_wavelengths is not None:
+            self.wavelengths = np.asarray(target_wavelengths, dtype=float)
+            self.resampler = SpectralResampler(self.wavelengths, dtype=dtype or np.float32)
+        else:
+            self.wavelengths = DEFAULT_WAVELENGTHS.copy()
+            self.resampler = None
+
+        # Opt-in on-disk cache of decoded cubes
+        self.cache = CubeCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir is not None else None
 
     def get_wavelengths(self):
         return self.wavelengths
 
     @staticmethod
-    def measurement_2_arr(measurement):
+    def get_measurement_wavelengths(measurement):
         cube = measurement.data.get("cube", None)
         if cube is None:
             raise Exception("Cube not found")
 
-        if measurement.processing_mode.name == 'Reflectance':
-            return cube.array/10000
-        else:
-            return cube.array
+        wavelengths = getattr(cube, 'wavelength', None)
+        if wavelengths is not None and len(wavelengths) > 0:
+            return np.asarray(wavelengths, dtype=float)
+
+        if cube.array.shape[2] != len(DEFAULT_WAVELENGTHS):
+            raise Exception(f"Measurement has {cube.array.shape[2]} bands and no wavelength information")
+        return DEFAULT_WAVELENGTHS
+
+    @staticmethod
+    def measurement_2_arr(measurement, dtype=None, lazy_scale=False):
+        """
+        Converts a measurement to a cube array.
+
+        Reflectance measurements are stored as integers in 1/10000. By default they are converted
+        to a float64 cube, with dtype the conversion happens in that dtype without a float64
+        temporary. With lazy_scale the SDK buffer is returned as a read-only view wrapped in a
+        ScaledCube, which scales the pixels on access.
+
+        :param measurement: The cuvis measurement.
+        :param dtype: Output dtype, e.g. np.float32, defaults to the current float64 behaviour.
+        :param lazy_scale: Return a zero-copy view instead of a converted copy.
+        :return: The cube as array or ScaledCube.
+        """
+        cube = measurement.data.get("cube", None)
+        if cube is None:
+            raise Exception("Cube not found")
+
+        scale = 1/10000 if measurement.processing_mode.name == 'Reflectance' else 1
+
+        if lazy_scale:
+            view = cube.array.view()
+            view.flags.writeable = False
+            return view if scale == 1 else ScaledCube(view, scale, dtype or np.float32)
+
+        if dtype is None:
+            return cube.array*scale if scale != 1 else cube.array
+
+        hsi = cube.array.astype(dtype)
+        if scale != 1:
+            hsi *= scale
+        return hsi
+
+    def _cache_variant(self):
+        variant = np.dtype(self.dtype).name if self.dtype is not None else 'native'
+        if self.lazy_scale:
+            variant += '-lazy'
+        if self.resampler is not None:
+            variant += '-' + ','.join(f'{w:g}' for w in self.wavelengths)
+        return variant
 
     @staticmethod
     def load_measurement(measurement_path):
+        instrumentation = active_instrumentation()
         try:
-            session = cuvis.SessionFile(measurement_path)
-            measurement = session[0]
-            assert measurement._handle
+            with instrumentation.stage('decode'):
+                session = cuvis.SessionFile(measurement_path)
+                measurement = session[0]
+                assert measurement._handle
         except Exception as e:
             print(e)
+            instrumentation.count('decode_errors')
             return None
 
+        if instrumentation.enabled:
+            instrumentation.count('cubes_decoded')
+            instrumentation.count('bytes_read', os.path.getsize(measurement_path))
+
         return measurement, session
 
-    def set_calibration(self, dark_ref, white_ref):
-        session_dark = cuvis.SessionFile(dark_ref)
-        self.dark = session_dark[0]
-        assert self.dark._handle
+    def load_array(self, measurement_path):
+        instrumentation = active_instrumentation()
+        if measurement_path.endswith('.npy'):
+            # Cubes that are already processed, e.g. calibrated by pipeline.py, are memory mapped as they are
+            with instrumentation.stage('cache_read'):
+                hsi = np.load(measurement_path, mmap_mode='r')
+            instrumentation.record(path=measurement_path, source='npy')
+            return hsi
 
-        session_white = cuvis.SessionFile(white_ref)
-        self.white = session_white[0]
-        assert self.white._handle
+        variant = self._cache_variant()
 
-    def raw2reflectance(self, measurement_session, dark_ref=None, white_ref=None):
-        measurement = measurement_session[0]
-        assert measurement._handle
+        if self.cache is not None:
+            with instrumentation.stage('cache_read'):
+                cached = self.cache.get(measurement_path, variant)
+            if cached is not None:
+                instrumentation.count('cache_hits')
+                instrumentation.record(path=measurement_path, source='cache')
+                hsi, meta = cached
+                if meta.get('scale', 1) != 1:
+                    return ScaledCube(hsi, meta['scale'], self.dtype or np.float32)
+                return hsi
+            instrumentation.count('cache_misses')
 
-        if dark_ref is None:
-            dark = self.dark
-        else:
-            session_dark = cuvis.SessionFile(dark_ref)
-            dark = session_dark[0]
-            assert dark._handle
+        start = time.perf_counter()
+        loaded = self.load_measurement(measurement_path)
+        if loaded is None:
+            instrumentation.record(path=measurement_path, source='cu3s', error=True)
+            raise Exception(f"Measurement could not be loaded: {measurement_path}")
 
-        if white_ref is None:
-            white = self.white
-        else:
-            session_white = cuvis.SessionFile(white_ref)
-            white = session_white[0]
-            assert white._handle
+        measurement, _ = loaded
+        with instrumentation.stage('scale'):
+            hsi = self.measurement_2_arr(measurement, dtype=self.dtype, lazy_scale=self.lazy_scale)
+
+        if self.resampler is not None:
+            with instrumentation.stage('resample'):
+                hsi = self.resampler.resample_cube(hsi, self.get_measurement_wavelengths(measurement))
+
+        if self.cache is not None:
+            with instrumentation.stage('cache_write'):
+                meta = {'processing_mode': measurement.processing_mode.name}
+                if isinstance(hsi, ScaledCube):
+                    # Lazily scaled cubes are cached as integers, the scale goes into the metadata
+                    self.cache.put(measurement_path, hsi.array, meta=dict(meta, scale=hsi.scale), variant=variant)
+                else:
+                    self.cache.put(measurement_path, hsi, meta=meta, variant=variant)
+
+        instrumentation.record(path=measurement_path, source='cu3s', seconds=time.perf_counter() - start,
+                               shape=list(hsi.shape))
 
+        return hsi
+
+    def _load_reference(self, reference_path):
+        # References are opened once per path and reused for every later calibration
+        if reference_path not in self._references:
+            session = cuvis.SessionFile(reference_path)
+            reference = session[0]
+            assert reference._handle
+            self._references[reference_path] = (reference, session)
+
+        return self._references[reference_path][0]
+
+    def set_calibration(self, dark_ref, white_ref):
+        self.dark = self._load_reference(dark_ref)
+        self.white = self._load_reference(white_ref)
+
+    @staticmethod
+    def _reflectance_context(measurement_session, dark, white):
         processing_context = cuvis.ProcessingContext(measurement_session)
 
         processing_context.set_reference(dark, cuvis.ReferenceType.Dark)
@@ -75,10 +224,84 @@ class HSIProcessor:
         proc_args.processing_mode = cuvis.ProcessingMode.Reflectance
 
         processing_context.set_processing_args(proc_args)
-        reflectance_measurement = processing_context.apply(measurement)
+
+        return processing_context
+
+    def raw2reflectance(self, measurement_session, dark_ref=None, white_ref=None):
+        measurement = measurement_session[0]
+        assert measurement._handle
+
+        dark = self.dark if dark_ref is None else self._load_reference(dark_ref)
+        white = self.white if white_ref is None else self._load_reference(white_ref)
+
+        with active_instrumentation().stage('calibrate'):
+            processing_context = self._reflectance_context(measurement_session, dark, white)
+            reflectance_measurement = processing_context.apply(measurement)
 
         return reflectance_measurement
 
+    def numpy_calibrator(self, dark_ref=None, white_ref=None, dtype=np.float32):
+        dark = self.dark if dark_ref is None else self._load_reference(dark_ref)
+        white = self.white if white_ref is None else self._load_reference(white_ref)
+
+        return ReflectanceCalibrator(self.measurement_2_arr(dark), self.measurement_2_arr(white), dtype=dtype)
+
+    def raw2reflectance_batch(self, measurement_paths, dark_ref=None, white_ref=None, as_array=True, engine='cuvis',
+                              chunk_rows=None):
+        """
+        Converts many raw measurements that share one dark/white reference pair to reflectance.
+
+        The references are loaded once and a single processing context, created from the first
+        measurement, is reused for the whole batch.
+
+        :param measurement_paths: Paths of the raw .cu3s measurements.
+        :param dark_ref: Path of the dark reference, defaults to the reference set by set_calibration.
+        :param white_ref: Path of the white reference, defaults to the reference set by set_calibration.
+        :param as_array: Yield reflectance cubes as arrays instead of cuvis measurements.
+        :param engine: 'cuvis' to use the cuvis ProcessingContext, 'numpy' to use a ReflectanceCalibrator.
+        :param chunk_rows: Number of image rows calibrated at once by the numpy engine.
+        :return: Generator of (measurement_path, reflectance), reflectance is None if loading failed.
+        """
+        if engine == 'numpy':
+            if not as_array:
+                raise ValueError("The numpy engine only produces arrays")
+
+            calibrator = self.numpy_calibrator(dark_ref, white_ref)
+            for measurement_path in measurement_paths:
+                loaded = self.load_measurement(measurement_path)
+                if loaded is None:
+                    yield measurement_path, None
+                    continue
+
+                raw = self.measurement_2_arr(loaded[0])
+                with active_instrumentation().stage('calibrate'):
+                    reflectance = calibrator.apply(raw, chunk_rows=chunk_rows)
+                yield measurement_path, reflectance
+            return
+        elif engine != 'cuvis':
+            raise ValueError(f"Unknown reflectance engine '{engine}'")
+
+        dark = self.dark if dark_ref is None else self._load_reference(dark_ref)
+        white = self.white if white_ref is None else self._load_reference(white_ref)
+
+        processing_context = None
+        for measurement_path in measurement_paths:
+            loaded = self.load_measurement(measurement_path)
+            if loaded is None:
+                yield measurement_path, None
+                continue
+
+            measurement, session = loaded
+            if processing_context is None:
+                processing_context = self._reflectance_context(session, dark, white)
+
+            with active_instrumentation().stage('calibrate'):
+                reflectance_measurement = processing_context.apply(measurement)
+            if as_array:
+                yield measurement_path, self.measurement_2_arr(reflectance_measurement)
+            else:
+                yield measurement_path, reflectance_measurement
+
 
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.realpath(__file__))
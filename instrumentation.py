@@ -0,0 +1,160 @@
+"""
+Optional per-stage timing and counters for the preprocessing pipeline.
+
+Pipeline code reports to the instrumentation returned by active(). By default that is a
+NullInstrumentation whose methods do nothing, so the hooks cost one function call when disabled.
+Enable it for a run with
+
+    with instrumented(trace=True) as instrumentation:
+        add_spectra(data)
+    instrumentation.report('run_summary.json')
+
+Stages and counters of thread pool workers are collected, process pool workers report to their
+own process and are not included.
+"""
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+def peak_rss():
+    """
+    :return: Peak resident set size of this process in bytes, or None if it can't be determined.
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    except ImportError:
+        return None
+
+
+class _Stage:
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumentation:
+    enabled = True
+
+    def __init__(self, trace=False):
+        self.tracing = trace
+        self.stages = {}
+        self.counters = {}
+        self.trace = []
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            calls, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (calls + 1, total + seconds)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, **fields):
+        if self.tracing:
+            with self._lock:
+                self.trace.append(fields)
+
+    def summary(self):
+        return {'wall_seconds': time.perf_counter() - self.start,
+                'stages': {name: {'calls': calls, 'seconds': seconds}
+                           for name, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1])},
+                'counters': dict(self.counters),
+                'peak_rss_bytes': peak_rss()}
+
+    def report(self, path=None):
+        """
+        Prints the summary and optionally writes it, together with the per-file trace, as JSON.
+        """
+        summary = self.summary()
+
+        print(f"Wall time: {summary['wall_seconds']:.2f} s")
+        for name, stage in summary['stages'].items():
+            print(f"  {name:24s} {stage['seconds']:10.3f} s {stage['calls']:8d} calls")
+        for name, value in summary['counters'].items():
+            print(f"  {name:24s} {value}")
+        if summary['peak_rss_bytes'] is not None:
+            print(f"  {'peak_rss':24s} {summary['peak_rss_bytes'] / 1024 ** 2:.1f} MiB")
+
+        if path is not None:
+            with open(path, 'w') as report_file:
+                json.dump(dict(summary, trace=self.trace), report_file, indent=2, default=str)
+
+        return summary
+
+
+class NullInstrumentation:
+    enabled = False
+    tracing = False
+
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def add_time(self, name, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def record(self, **fields):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+_active = NULL_INSTRUMENTATION
+
+
+def active():
+    return _active
+
+
+def enable(trace=False):
+    global _active
+    _active = Instrumentation(trace=trace)
+    return _active
+
+
+def disable():
+    global _active
+    instrumentation, _active = _active, NULL_INSTRUMENTATION
+    return instrumentation
+
+
+@contextmanager
+def instrumented(trace=False):
+    instrumentation = enable(trace=trace)
+    try:
+        yield instrumentation
+    finally:
+        disable()
@@ -0,0 +1,250 @@
+"""
+Headless batch runner for the preprocessing pipeline.
+
+Chains discovery of the .cu3s files, mapping of the annotations to the images, optional reflectance
+calibration, spectrum extraction into a spectral dataset and export of the pixel spectra. Every stage
+writes its output to the work directory and later stages read it from there, so stages can be run
+separately and an interrupted run continues where it stopped.
+
+Usage:
+    python pipeline.py --image-dir images --annotations annotations.csv --work-dir run --workers 8
+    python pipeline.py --work-dir run --stages calibrate extract --dark dark.cu3s --white white.cu3s
+"""
+import os
+import json
+import argparse
+from contextlib import nullcontext
+
+import numpy as np
+
+from instrumentation import instrumented
+from discovery import discover_cu3s_files
+
+
+STAGES = ['discover', 'map', 'calibrate', 'extract', 'export']
+
+
+def work_path(args, name):
+    return os.path.join(args.work_dir, name)
+
+
+def processor_kwargs(args):
+    kwargs = {}
+    if args.cache_dir:
+        kwargs['cache_dir'] = args.cache_dir
+    if args.dtype:
+        kwargs['dtype'] = np.dtype(args.dtype)
+    return kwargs
+
+
+def write_json(data, path):
+    # Written to a temporary file first, so an interrupted run never leaves a truncated file behind
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(path + '.tmp', path)
+
+
+def read_json(path, stage):
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run the '{stage}' stage first")
+    with open(path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def load_annotated_images(args):
+    data = read_json(work_path(args, 'annotations.json'), 'map')
+    for annotations in data.values():
+        for details in annotations.values():
+            details['coordinates'] = tuple(details['coordinates'])
+    return data
+
+
+def clear_dataset(path):
+    # Removes the parts and the index of a spectral dataset, so extraction starts over
+    if not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        if name == 'index.json' or name.endswith('.npz'):
+            os.remove(os.path.join(path, name))
+
+
+def run_discover(args):
+    # With resume the manifest makes rescans only list directories that changed
+    manifest_path = work_path(args, 'discovery_manifest.json') if args.resume else None
+    result = discover_cu3s_files(args.image_dir, manifest_path=manifest_path)
+
+    write_json(result.file_dict, work_path(args, 'files.json'))
+    print(f"Discovered {len(result.file_list)} files")
+
+
+def run_map(args):
+    from hsi_analysis import read_annotations, map_annotations_to_images
+
+    if args.annotations is None:
+        raise ValueError("The 'map' stage needs --annotations")
+
+    file_dict = read_json(work_path(args, 'files.json'), 'discover')
+    data = map_annotations_to_images(file_dict, read_annotations(args.annotations))
+
+    # Annotations of images that weren't found are reported by map_annotations_to_images and left out
+    unmapped = [image_name for image_name, annotations in data.items()
+                if any(details['image_path'] is None for details in annotations.values())]
+    for image_name in unmapped:
+        del data[image_name]
+
+    write_json(data, work_path(args, 'annotations.json'))
+    print(f"Mapped {sum(len(annotations) for annotations in data.values())} annotations on {len(data)} images")
+
+
+def calibrate_worker(paths, dark, white, engine, dtype, kwargs):
+    """
+    Calibrates (measurement_path, out_path) pairs and writes the reflectance cubes as .npy.
+
+    :return: Measurement paths that could not be calibrated.
+    """
+    from hsi_processor import HSIProcessor
+
+    processor = HSIProcessor(**kwargs)
+    out_paths = dict(paths)
+    failed = []
+    for path, reflectance in processor.raw2reflectance_batch(list(out_paths), dark, white, engine=engine):
+        if reflectance is None:
+            failed.append(path)
+            continue
+
+        out_path = out_paths[path]
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path + '.tmp', 'wb') as npy_file:
+            np.save(npy_file, np.asarray(reflectance, dtype=dtype))
+        os.replace(out_path + '.tmp', out_path)
+
+    return failed
+
+
+def run_calibrate(args):
+    from cube_loader import EXECUTORS
+
+    if args.dark is None or args.white is None:
+        print("No --dark and --white references given, skipping calibration")
+        return
+
+    data = load_annotated_images(args)
+    out_dir = work_path(args, 'reflectance')
+
+    # Calibrated cubes are stored as .npy in the work directory and replace the raw paths
+    out_paths = {}
+    for annotations in data.values():
+        for details in annotations.values():
+            path = details['image_path']
+            if path.endswith('.npy'):
+                continue
+            name = os.path.splitext(os.path.basename(path))[0] + '.npy'
+            out_paths[path] = os.path.join(out_dir, details['patient_id'], details['body_part'], name)
+
+    pending = [path for path, out_path in out_paths.items() if not (args.resume and os.path.exists(out_path))]
+    print(f"Calibrating {len(pending)} of {len(out_paths)} images")
+
+    # Every worker calibrates its share of the images with its own processor, so the references are loaded
+    # once per worker and reused for all of its images
+    workers = max(1, min(args.workers, len(pending)))
+    shares = [[(path, out_paths[path]) for path in pending[i::workers]] for i in range(workers)]
+    failed = set()
+    with EXECUTORS[args.mode](max_workers=workers) as executor:
+        futures = [executor.submit(calibrate_worker, share, args.dark, args.white, args.engine,
+                                   args.dtype or 'float32', processor_kwargs(args)) for share in shares if share]
+        for future in futures:
+            failed.update(future.result())
+
+    # Annotations of images that couldn't be calibrated are reported and left out, so raw values never
+    # end up in the dataset next to reflectance
+    for image_name in list(data):
+        annotations = data[image_name]
+        if any(details['image_path'] in failed for details in annotations.values()):
+            print(f"Leaving out the {len(annotations)} annotations of {image_name}, calibration failed")
+            del data[image_name]
+            continue
+        for details in annotations.values():
+            if details['image_path'] in out_paths:
+                details['image_path'] = out_paths[details['image_path']]
+
+    write_json(data, work_path(args, 'annotations.json'))
+    if failed:
+        print(f"{len(failed)} images could not be calibrated")
+
+
+def run_extract(args):
+    from hsi_analysis import extract_spectra_to_dataset
+
+    data = load_annotated_images(args)
+    if not args.resume:
+        clear_dataset(work_path(args, 'dataset'))
+
+    written = extract_spectra_to_dataset(data, work_path(args, 'dataset'), kernel_size=args.kernel_size,
+                                         workers=args.workers, mode=args.mode,
+                                         processor_kwargs=processor_kwargs(args))
+    print(f"Extracted {written} spectra")
+
+
+def run_export(args):
+    from pixel_export import export_pixel_spectra
+
+    data = load_annotated_images(args)
+    file_list = sorted({details['image_path'] for annotations in data.values() for details in annotations.values()})
+
+    out_dir = work_path(args, 'pixels')
+    index_path = os.path.join(out_dir, 'index.json')
+    if args.resume and os.path.exists(index_path):
+        with open(index_path, 'r') as index_file:
+            exported = {entry['source'] for entry in json.load(index_file)['files']}
+        if exported.issuperset(file_list):
+            print(f"Pixel spectra of all {len(file_list)} images already exported")
+            return
+
+    results = export_pixel_spectra(file_list, out_dir, bin_size=args.bin_size, workers=args.workers,
+                                   mode=args.mode, processor_kwargs=processor_kwargs(args))
+    print(f"Exported the pixel spectra of {sum(error is None for _, _, error in results)} images")
+
+
+STAGE_FUNCTIONS = {'discover': run_discover, 'map': run_map, 'calibrate': run_calibrate, 'extract': run_extract,
+                   'export': run_export}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--image-dir', help='Root of the patient/body part image tree')
+    parser.add_argument('--annotations', help='Annotation CSV file')
+    parser.add_argument('--work-dir', required=True, help='Directory for the outputs of all stages')
+    parser.add_argument('--stages', nargs='*', choices=STAGES, default=STAGES,
+                        help='Stages to run, in pipeline order')
+    parser.add_argument('--dark', help='Dark reference for calibration')
+    parser.add_argument('--white', help='White reference for calibration')
+    parser.add_argument('--engine', choices=['cuvis', 'numpy'], default='cuvis', help='Reflectance engine')
+    parser.add_argument('--kernel-size', type=int, default=7)
+    parser.add_argument('--bin-size', type=int, default=1, help='Spatial binning of the exported pixel spectra')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Workers of the calibrate, extract and export stages')
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread',
+                        help='Thread or process pool of the workers')
+    parser.add_argument('--dtype', choices=['float32', 'float64'], help='Dtype of the loaded cubes')
+    parser.add_argument('--cache-dir', help='Directory of the decoded cube cache')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='Recompute all outputs instead of continuing a previous run')
+    parser.add_argument('--profile', help='Write per-stage timings and counters as JSON to this path')
+    args = parser.parse_args()
+
+    if 'discover' in args.stages and args.image_dir is None:
+        parser.error("the 'discover' stage needs --image-dir")
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    with instrumented(trace=True) if args.profile else nullcontext() as instrumentation:
+        for stage in STAGES:
+            if stage in args.stages:
+                print(f"== {stage}")
+                STAGE_FUNCTIONS[stage](args)
+
+    if instrumentation is not None:
+        instrumentation.report(args.profile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import os
+import json
+
+import numpy as np
+
+from hsi_processor import HSIProcessor
+from cube_loader import EXECUTORS
+
+
+def binned_shape(hsi, bin_size=1):
+    # Only whole bins are exported, remaining pixels at the bottom and right border are dropped
+    return hsi.shape[0] // bin_size, hsi.shape[1] // bin_size, hsi.shape[2]
+
+
+def iter_pixel_tiles(hsi, tile_size=256, bin_size=1, dtype=np.float32):
+    """
+    Streams the pixel spectra of a cube as fixed-size tiles.
+
+    Only one tile at a time is converted to dtype and no copy of the whole cube is made here, so memory-mapped
+    cubes and ScaledCubes stay on disk or in their integer representation. Cubes loaded by load_array without
+    lazy_scale are already scaled copies, export_pixel_spectra therefore loads lazily scaled cubes by default.
+
+    :param hsi: The hyperspectral cube with shape (height, width, bands).
+    :param tile_size: Edge length of a tile in (binned) output pixels.
+    :param bin_size: Edge length of the square pixel bins that are averaged into one spectrum.
+    :param dtype: Dtype of the tiles.
+    :return: Generator of (row, col, tile), row and col are the tile offset in output pixels and tile
+             has shape (tile_rows, tile_cols, bands).
+    """
+    out_height, out_width, bands = binned_shape(hsi, bin_size)
+
+    for row in range(0, out_height, tile_size):
+        row_stop = min(row + tile_size, out_height)
+        for col in range(0, out_width, tile_size):
+            col_stop = min(col + tile_size, out_width)
+
+            tile = np.asarray(hsi[row * bin_size:row_stop * bin_size, col * bin_size:col_stop * bin_size, :],
+                              dtype=dtype)
+            if bin_size > 1:
+                tile = tile.reshape(row_stop - row, bin_size, col_stop - col, bin_size, bands).mean(axis=(1, 3),
+                                                                                                   dtype=dtype)
+            yield row, col, tile
+
+
+def export_cube_pixels(hsi, out_path, tile_size=256, bin_size=1, dtype=np.float32):
+    """
+    Writes all (binned) pixel spectra of a cube tile by tile to a memory-mapped .npy file.
+
+    :return: Shape of the written array (height, width, bands).
+    """
+    shape = binned_shape(hsi, bin_size)
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=dtype, shape=shape)
+
+    for row, col, tile in iter_pixel_tiles(hsi, tile_size=tile_size, bin_size=bin_size, dtype=dtype):
+        out[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+
+    out.flush()
+    del out
+
+    return shape
+
+
+def _export_worker(measurement_path, out_path, tile_size, bin_size, dtype, processor_kwargs):
+    # The cube is decoded and written inside the worker, only the file name goes back. Lazy scaling keeps the
+    # integer cube and scales tile by tile instead of building a float64 copy of the whole image
+    processor_kwargs = dict(processor_kwargs)
+    processor_kwargs.setdefault('lazy_scale', True)
+    processor = HSIProcessor(**processor_kwargs)
+    hsi = processor.load_array(measurement_path)
+    return export_cube_pixels(hsi, out_path, tile_size=tile_size, bin_size=bin_size, dtype=dtype)
+
+
+def export_pixel_spectra(file_list, out_dir, tile_size=256, bin_size=1, dtype=np.float32, workers=None,
+                         mode='process', processor_kwargs=None):
+    """
+    Exports the pixel spectra of many cubes in parallel, one .npy file per cube.
+
+    An index.json in out_dir maps every exported file to its source measurement and shape.
+
+    :param file_list: Paths of the .cu3s measurements.
+    :param out_dir: Output directory.
+    :param workers: Number of workers, defaults to the number of CPUs.
+    :param mode: 'thread' or 'process'.
+    :param processor_kwargs: Arguments of the HSIProcessor of every worker, lazy_scale defaults to True.
+    :return: List of (measurement_path, out_path, error) in input order.
+    """
+    if mode not in EXECUTORS:
+        raise ValueError(f"Unknown export mode '{mode}', expected one of {list(EXECUTORS)}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    processor_kwargs = processor_kwargs or {}
+    dtype = np.dtype(dtype)
+
+    out_paths = [os.path.join(out_dir, f"{i:05d}_{os.path.splitext(os.path.basename(path))[0]}.npy")
+                 for i, path in enumerate(file_list)]
+
+    results = []
+    index = []
+    with EXECUTORS[mode](max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = [executor.submit(_export_worker, path, out_path, tile_size, bin_size, dtype, processor_kwargs)
+                   for path, out_path in zip(file_list, out_paths)]
+
+        for path, out_path, future in zip(file_list, out_paths, futures):
+            try:
+                shape = future.result()
+            except Exception as e:
+                print(f"Failed to export {path}: {e}")
+                results.append((path, None, e))
+                continue
+
+            results.append((path, out_path, None))
+            index.append({'source': path, 'file': os.path.basename(out_path), 'shape': list(shape)})
+
+    with open(os.path.join(out_dir, 'index.json'), 'w') as index_file:
+        json.dump({'bin_size': bin_size, 'dtype': dtype.name, 'files': index}, index_file)
+
+    return results
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class ReflectanceCalibrator:
+    """
+    Converts raw cubes to reflectance with (raw - dark) / (white - dark) in plain NumPy.
+
+    The dark frame and the inverse of the white - dark denominator are computed once per
+    reference pair, so calibrating a cube costs one subtraction and one multiplication per
+    value. References can be full frames (height, width, bands) or single spectra (bands,).
+    The calibrator does not depend on cuvis and can be pickled to worker processes.
+    """
+
+    def __init__(self, dark, white, dtype=np.float32):
+        self.dtype = np.dtype(dtype)
+
+        self.dark = np.asarray(dark).astype(self.dtype)
+        denominator = np.asarray(white).astype(self.dtype) - self.dark
+
+        # Pixels without signal in the white reference are mapped to 0 instead of inf
+        with np.errstate(divide='ignore'):
+            self.inv_denominator = np.where(denominator == 0, 0, 1 / denominator).astype(self.dtype)
+
+    @staticmethod
+    def _rows(reference, start, stop, height):
+        # Full frame references are sliced with the cube, spectra broadcast over all rows
+        if reference.ndim == 3 and reference.shape[0] == height:
+            return reference[start:stop]
+        return reference
+
+    def apply(self, raw, out=None, inplace=False, chunk_rows=None):
+        """
+        :param raw: Raw cube with shape (height, width, bands).
+        :param out: Optional preallocated output array with the shape of raw.
+        :param inplace: Write the result into raw, which then has to be a float array.
+        :param chunk_rows: Number of image rows processed at once, defaults to the whole cube.
+        :return: The reflectance cube.
+        """
+        raw = np.asarray(raw)
+
+        if inplace:
+            if not np.issubdtype(raw.dtype, np.floating):
+                raise ValueError(f"In-place calibration needs a float cube, got {raw.dtype}")
+            out = raw
+        elif out is None:
+            out = np.empty(raw.shape, dtype=self.dtype)
+
+        height = raw.shape[0]
+        chunk_rows = chunk_rows or height
+
+        for start in range(0, height, chunk_rows):
+            stop = min(start + chunk_rows, height)
+            np.subtract(raw[start:stop], self._rows(self.dark, start, stop, height), out=out[start:stop],
+                        casting='unsafe')
+            np.multiply(out[start:stop], self._rows(self.inv_denominator, start, stop, height), out=out[start:stop],
+                        casting='unsafe')
+
+        return out
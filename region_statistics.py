@@ -0,0 +1,134 @@
+import numpy as np
+
+
+def rectangle_mask(shape, x0, y0, x1, y1):
+    """
+    :param shape: (height, width) of the image.
+    :return: Boolean mask of the pixels inside the rectangle, the corners are inclusive.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    x0, x1 = sorted((int(round(x0)), int(round(x1))))
+    y0, y1 = sorted((int(round(y0)), int(round(y1))))
+    mask[max(y0, 0):max(y1 + 1, 0), max(x0, 0):max(x1 + 1, 0)] = True
+    return mask
+
+
+def polygon_mask(shape, vertices):
+    """
+    :param shape: (height, width) of the image.
+    :param vertices: Sequence of (x, y) polygon vertices in pixel coordinates.
+    :return: Boolean mask of the pixels whose centre lies inside the polygon.
+    """
+    from matplotlib.path import Path
+
+    vertices = np.asarray(vertices, dtype=float)
+    mask = np.zeros(shape, dtype=bool)
+
+    # Only the pixels in the bounding box of the polygon are tested
+    x0, y0 = np.maximum(np.floor(vertices.min(axis=0)).astype(int), 0)
+    x1, y1 = np.minimum(np.ceil(vertices.max(axis=0)).astype(int), (shape[1] - 1, shape[0] - 1))
+    if x1 < x0 or y1 < y0:
+        return mask
+
+    ys, xs = np.mgrid[y0:y1 + 1, x0:x1 + 1]
+    inside = Path(vertices).contains_points(np.column_stack([xs.ravel(), ys.ravel()]))
+    mask[y0:y1 + 1, x0:x1 + 1] = inside.reshape(xs.shape)
+    return mask
+
+
+def brush_mask(shape, points, radius=3):
+    """
+    :param shape: (height, width) of the image.
+    :param points: Sequence of (x, y) centres of the brush strokes.
+    :param radius: Brush radius in pixels.
+    :return: Boolean mask of the pixels within radius of any point.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    offsets = np.arange(-int(radius), int(radius) + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing='ij')
+    disc = dx ** 2 + dy ** 2 <= radius ** 2
+
+    points = np.round(np.asarray(points, dtype=float)).astype(int).reshape(-1, 2)
+    ys = (points[:, 1, None] + dy[disc]).ravel()
+    xs = (points[:, 0, None] + dx[disc]).ravel()
+    inside = (ys >= 0) & (ys < shape[0]) & (xs >= 0) & (xs < shape[1])
+    mask[ys[inside], xs[inside]] = True
+    return mask
+
+
+def masks_to_labels(masks):
+    """
+    Combines boolean masks into one label image, region i gets label i + 1 and 0 is background.
+    Pixels covered by several masks belong to the last one. Pass n_regions=len(masks) to
+    region_statistics to get a row for every mask.
+    """
+    labels = np.zeros(masks[0].shape, dtype=np.int32)
+    for i, mask in enumerate(masks):
+        labels[mask] = i + 1
+    return labels
+
+
+def region_statistics(hsi, labels, percentiles=(25, 50, 75), n_regions=None):
+    """
+    Computes spectral statistics of all labelled regions of a cube in one vectorized pass.
+
+    Only the labelled pixels are read from the cube. Means and standard deviations are label
+    reductions with np.bincount, percentiles are read from one sort of the pixels by label and value.
+
+    :param hsi: The hyperspectral cube with shape (height, width, bands).
+    :param labels: Integer label image with shape (height, width), 0 is background.
+    :param percentiles: Percentiles computed per region and band, with linear interpolation.
+    :param n_regions: Number of regions, defaults to labels.max().
+    :return: Dictionary with 'labels' (R,), 'count' (R,), 'mean', 'std', 'median' (R, bands) and
+             'percentiles' (R, len(percentiles), bands) for the labels 1 to R.
+             Regions without pixels get NaN statistics.
+    """
+    labels = np.asarray(labels)
+    height, width = labels.shape
+    n_labels = max(int(labels.max()) if labels.size else 0, n_regions or 0) + 1
+
+    pixel_index = np.flatnonzero(labels.ravel() > 0)
+    region = labels.ravel()[pixel_index].astype(np.intp)
+    values = np.asarray(hsi[pixel_index // width, pixel_index % width, :], dtype=np.float64)
+    n_bands = values.shape[1]
+
+    # Flattened (label, band) bins, so every reduction is a single bincount over all bands
+    bins = (region[:, None] * n_bands + np.arange(n_bands)).ravel()
+    count = np.bincount(region, minlength=n_labels)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sums = np.bincount(bins, weights=values.ravel(), minlength=n_labels * n_bands).reshape(n_labels, n_bands)
+        mean = sums / count[:, None]
+
+        squared = (values - mean[region]) ** 2
+        variance = np.bincount(bins, weights=squared.ravel(), minlength=n_labels * n_bands).reshape(n_labels, n_bands)
+        std = np.sqrt(variance / count[:, None])
+
+    # Sort by value, then stably by label, giving the values of every region in ascending order per band
+    order = np.argsort(values, axis=0, kind='stable')
+    order = np.take_along_axis(order, np.argsort(region[order], axis=0, kind='stable'), axis=0)
+    sorted_values = np.take_along_axis(values, order, axis=0)
+
+    # The median is computed together with the requested percentiles
+    quantile_levels = np.append(np.asarray(percentiles, dtype=float), 50)
+
+    starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+    positions = starts[:, None] + quantile_levels[None, :] / 100 * np.maximum(count - 1, 0)[:, None]
+    lower = np.floor(positions).astype(np.intp)
+    upper = np.ceil(positions).astype(np.intp)
+    fraction = (positions - lower)[:, :, None]
+
+    if len(sorted_values):
+        lower = np.minimum(lower, len(sorted_values) - 1)
+        upper = np.minimum(upper, len(sorted_values) - 1)
+        quantiles = sorted_values[lower] * (1 - fraction) + sorted_values[upper] * fraction
+    else:
+        quantiles = np.full(positions.shape + (n_bands,), np.nan)
+    quantiles[count == 0] = np.nan
+
+    return {'labels': np.arange(1, n_labels),
+            'count': count[1:],
+            'mean': mean[1:],
+            'std': std[1:],
+            'median': quantiles[1:, -1],
+            'percentiles': quantiles[1:, :-1]}
@@ -0,0 +1,119 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+
+META_COLUMNS = ['image_name', 'patient_id', 'body_part', 'annotation_type', 'x', 'y']
+
+INDEX_FILE = 'index.json'
+
+
+class SpectralDatasetWriter:
+    """
+    Writes spectra with their annotation metadata to a columnar dataset directory.
+
+    Every call to append stores one part file (.npz) with one array per metadata column and
+    a dense float32 reflectance matrix. An index.json lists the parts and the wavelengths.
+    Opening an existing dataset continues appending to it.
+    """
+
+    def __init__(self, path, wavelengths):
+        self.path = path
+        self.wavelengths = [float(w) for w in wavelengths]
+        os.makedirs(path, exist_ok=True)
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as index_file:
+                self.index = json.load(index_file)
+            if not np.allclose(self.index['wavelengths'], self.wavelengths):
+                raise ValueError(f"Wavelengths do not match the existing dataset {path}")
+        else:
+            self.index = {'wavelengths': self.wavelengths, 'parts': []}
+
+    def append(self, meta, spectra, sources=None):
+        """
+        :param meta: DataFrame or dictionary with one sequence per column of META_COLUMNS.
+        :param spectra: Array of shape (N, len(wavelengths)).
+        :param sources: Optional source images completed by this part, used to resume interrupted runs.
+        """
+        spectra = np.asarray(spectra, dtype=np.float32)
+        if spectra.ndim != 2 or spectra.shape[1] != len(self.wavelengths):
+            raise ValueError(f"Expected spectra of shape (N, {len(self.wavelengths)}), got {spectra.shape}")
+        if len(spectra) == 0:
+            return
+
+        columns = {}
+        for column in META_COLUMNS:
+            values = np.asarray(meta[column])
+            if len(values) != len(spectra):
+                raise ValueError(f"Column '{column}' has {len(values)} rows, expected {len(spectra)}")
+            columns[column] = values.astype(np.int64) if column in ('x', 'y') else values.astype(str)
+
+        part_name = f"part-{len(self.index['parts']):05d}.npz"
+        np.savez(os.path.join(self.path, part_name), spectra=spectra, **columns)
+
+        part = {'file': part_name, 'rows': len(spectra)}
+        if sources:
+            part['sources'] = list(sources)
+
+        # The part only becomes visible with the index, so an interrupted append leaves no partial rows
+        self.index['parts'].append(part)
+        self._write_index()
+
+    def completed_sources(self):
+        return {source for part in self.index['parts'] for source in part.get('sources', [])}
+
+    def _write_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(index_path + '.tmp', index_path)
+
+
+def iter_spectral_dataset(path):
+    """
+    Reads a dataset part by part, so datasets larger than memory can be processed in chunks.
+
+    :return: Generator of (metadata DataFrame, float32 spectra, wavelengths) per part.
+    """
+    with open(os.path.join(path, INDEX_FILE), 'r') as index_file:
+        index = json.load(index_file)
+
+    wavelengths = np.asarray(index['wavelengths'])
+    for part in index['parts']:
+        with np.load(os.path.join(path, part['file'])) as data:
+            meta = pd.DataFrame({column: data[column] for column in META_COLUMNS})
+            yield meta, data['spectra'], wavelengths
+
+
+def read_spectral_dataset(path):
+    """
+    Reads a dataset written by SpectralDatasetWriter.
+
+    :param path: The dataset directory.
+    :return: Tuple of the metadata DataFrame, the float32 spectra matrix and the wavelengths.
+    """
+    with open(os.path.join(path, INDEX_FILE), 'r') as index_file:
+        index = json.load(index_file)
+
+    wavelengths = np.asarray(index['wavelengths'])
+    n_rows = sum(part['rows'] for part in index['parts'])
+
+    spectra = np.empty((n_rows, len(wavelengths)), dtype=np.float32)
+    columns = {column: [] for column in META_COLUMNS}
+
+    row = 0
+    for part in index['parts']:
+        with np.load(os.path.join(path, part['file'])) as data:
+            spectra[row:row + part['rows']] = data['spectra']
+            for column in META_COLUMNS:
+                columns[column].append(data[column])
+        row += part['rows']
+
+    meta = pd.DataFrame({column: np.concatenate(values) if values else np.array([])
+                         for column, values in columns.items()})
+
+    return meta, spectra, wavelengths
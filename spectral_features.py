@@ -0,0 +1,190 @@
+import numpy as np
+
+from spectral_resampling import interpolation_matrix
+
+
+def _divide(numerator, denominator):
+    # Pixels without signal in the denominator become NaN instead of inf
+    return np.divide(numerator, denominator, out=np.full_like(numerator, np.nan), where=denominator != 0)
+
+
+class Feature:
+    """
+    A per-pixel feature computed from the reflectance at a few wavelengths.
+
+    :param wavelengths: Wavelengths the feature needs, interpolated linearly between the bands of the cube.
+    :param function: Called with one (rows, width) array per wavelength, returns the (rows, width) feature map.
+    """
+
+    def __init__(self, wavelengths, function, description=''):
+        self.wavelengths = tuple(float(w) for w in wavelengths)
+        self.function = function
+        self.description = description
+
+    def __call__(self, *reflectances):
+        return self.function(*reflectances)
+
+
+def band_ratio(numerator, denominator):
+    return Feature((numerator, denominator), _divide, f'R({numerator:g}) / R({denominator:g})')
+
+
+def normalized_difference(a, b):
+    return Feature((a, b), lambda ra, rb: _divide(ra - rb, ra + rb), f'Normalized difference of {a:g} and {b:g} nm')
+
+
+def first_derivative(wavelength, step=5):
+    return Feature((wavelength - step, wavelength + step), lambda low, high: (high - low) / (2 * step),
+                   f'dR/dλ at {wavelength:g} nm')
+
+
+def _band_depth(left, centre, right):
+    # The continuum is the straight line between the two shoulders of the absorption band
+    t = (centre - left) / (right - left)
+
+    def depth(r_left, r_centre, r_right):
+        return 1 - _divide(r_centre, (1 - t) * r_left + t * r_right)
+
+    return depth
+
+
+def band_depth(left, centre, right):
+    return Feature((left, centre, right), _band_depth(left, centre, right),
+                   f'Continuum removed depth at {centre:g} nm')
+
+
+def haemoglobin_index(absorbing=560, reference=650):
+    # Absorbance difference log(1/R(absorbing)) - log(1/R(reference))
+    def index(r_absorbing, r_reference):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.log(_divide(r_reference, r_absorbing))
+
+    return Feature((absorbing, reference), index, f'Haemoglobin index A({absorbing:g}) - A({reference:g})')
+
+
+def oxygenation_proxy(oxy=(540, 577, 610), deoxy=(730, 760, 790)):
+    # Share of the oxy-haemoglobin band depth in the sum of the oxy- and deoxy-haemoglobin band depths
+    oxy_depth = _band_depth(*oxy)
+    deoxy_depth = _band_depth(*deoxy)
+
+    def proxy(*reflectances):
+        d_oxy = np.clip(oxy_depth(*reflectances[:3]), 0, None)
+        d_deoxy = np.clip(deoxy_depth(*reflectances[3:]), 0, None)
+        return _divide(d_oxy, d_oxy + d_deoxy)
+
+    return Feature(tuple(oxy) + tuple(deoxy), proxy, 'Oxygenation proxy from the 577 and 760 nm band depths')
+
+
+DEFAULT_FEATURES = {
+    'ratio_800_650': band_ratio(800, 650),
+    'ndi_800_650': normalized_difference(800, 650),
+    'derivative_700': first_derivative(700),
+    'depth_577': band_depth(540, 577, 610),
+    'haemoglobin_index': haemoglobin_index(),
+    'oxygenation_proxy': oxygenation_proxy(),
+}
+
+
+def _tolerance(wavelengths):
+    # Feature wavelengths may exceed the range of the cube by half a band
+    return np.diff(wavelengths).max() / 2 if len(wavelengths) > 1 else 0.5
+
+
+def available_features(wavelengths, features=None):
+    """
+    Splits features into those the wavelength grid covers and those it doesn't.
+
+    :return: Tuple of a dictionary of the available features and a list of the names of the unavailable ones.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    features = DEFAULT_FEATURES if features is None else features
+    tolerance = _tolerance(wavelengths)
+
+    available, unavailable = {}, []
+    for name, feature in features.items():
+        if all(wavelengths[0] - tolerance <= w <= wavelengths[-1] + tolerance for w in feature.wavelengths):
+            available[name] = feature
+        else:
+            unavailable.append(name)
+    return available, unavailable
+
+
+class FeatureEngine:
+    """
+    Computes whole-image feature maps of a cube in one pass over its rows.
+
+    Without explicit features the DEFAULT_FEATURES covered by the wavelengths are used, the
+    names of the others are listed in unavailable. Explicit features must all be covered.
+
+    All wavelengths the features need are sampled from each chunk of rows with a single
+    interpolation matrix product, the features are elementwise operations on the samples.
+    Cubes are read chunk_rows rows at a time in float32, so arrays, memory maps and
+    ScaledCubes are never converted as a whole.
+    """
+
+    def __init__(self, wavelengths, features=None, dtype=np.float32, chunk_rows=256):
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        if features is None:
+            self.features, self.unavailable = available_features(self.wavelengths)
+        else:
+            self.features, self.unavailable = dict(features), []
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+
+        # Wavelengths between two bands are interpolated
+        self.samples = sorted({w for feature in self.features.values() for w in feature.wavelengths})
+        if self.samples:
+            matrix = interpolation_matrix(self.wavelengths, self.samples, tolerance=_tolerance(self.wavelengths))
+            matrix = matrix.toarray() if hasattr(matrix, 'toarray') else matrix
+        else:
+            matrix = np.zeros((0, len(self.wavelengths)))
+        self.matrix = np.asarray(matrix, dtype=self.dtype).T
+        self._sample_index = {w: i for i, w in enumerate(self.samples)}
+
+    def names(self):
+        return list(self.features)
+
+    def _chunks(self, cube):
+        for start in range(0, cube.shape[0], self.chunk_rows):
+            stop = min(start + self.chunk_rows, cube.shape[0])
+            yield start, stop, np.asarray(cube[start:stop], dtype=self.dtype)
+
+    def compute(self, cube, names=None):
+        """
+        :param cube: Cube of shape (height, width, bands) on the wavelengths of the engine.
+        :param names: Features to compute, defaults to all features.
+        :return: Dictionary mapping feature names to (height, width) maps in dtype.
+        """
+        names = self.names() if names is None else list(names)
+        for name in names:
+            if name not in self.features:
+                raise ValueError(f"Unknown feature '{name}', expected one of {self.names()}")
+        if cube.shape[2] != len(self.wavelengths):
+            raise ValueError(f"Cube has {cube.shape[2]} bands, the engine expects {len(self.wavelengths)}")
+
+        maps = {name: np.empty(cube.shape[:2], dtype=self.dtype) for name in names}
+        for start, stop, block in self._chunks(cube):
+            sampled = block @ self.matrix
+            for name in names:
+                feature = self.features[name]
+                maps[name][start:stop] = feature(*(sampled[..., self._sample_index[w]] for w in feature.wavelengths))
+
+        return maps
+
+    def compute_stack(self, cube, names=None):
+        """
+        :return: Tuple of the feature names and a (height, width, features) stack of their maps.
+        """
+        maps = self.compute(cube, names)
+        if not maps:
+            return [], np.empty(cube.shape[:2] + (0,), dtype=self.dtype)
+        return list(maps), np.stack(list(maps.values()), axis=2)
+
+    def derivative(self, cube):
+        """
+        :return: First derivative spectra dR/dλ of every pixel as a (height, width, bands) cube in dtype.
+        """
+        derivative = np.empty(cube.shape, dtype=self.dtype)
+        for start, stop, block in self._chunks(cube):
+            derivative[start:stop] = np.gradient(block, self.wavelengths, axis=2)
+        return derivative
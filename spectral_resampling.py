@@ -0,0 +1,102 @@
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from scipy import sparse
+except ImportError:  # scipy is optional, the matrices are small enough to be applied dense
+    sparse = None
+
+
+@lru_cache(maxsize=64)
+def _interpolation_matrix(source, target, tolerance):
+    source = np.asarray(source, dtype=float)
+    target = np.asarray(target, dtype=float)
+
+    if len(source) < 2:
+        raise ValueError("At least two source wavelengths are needed for interpolation")
+    if np.any(np.diff(source) <= 0):
+        raise ValueError("Source wavelengths must be strictly increasing")
+    outside = (target < source[0] - tolerance) | (target > source[-1] + tolerance)
+    if np.any(outside):
+        raise ValueError(f"Target wavelengths {target[outside].tolist()} are outside of the source range "
+                         f"{source[0]} - {source[-1]} nm")
+
+    # Every target band is a linear combination of its two neighbouring source bands
+    upper = np.clip(np.searchsorted(source, target), 1, len(source) - 1)
+    lower = upper - 1
+    span = source[upper] - source[lower]
+    weight_upper = np.clip(np.divide(target - source[lower], span, out=np.zeros(len(target)), where=span > 0), 0, 1)
+
+    rows = np.concatenate([np.arange(len(target)), np.arange(len(target))])
+    cols = np.concatenate([lower, upper])
+    weights = np.concatenate([1 - weight_upper, weight_upper])
+    keep = weights != 0
+
+    if sparse is not None:
+        matrix = sparse.csr_matrix((weights[keep], (rows[keep], cols[keep])), shape=(len(target), len(source)))
+    else:
+        matrix = np.zeros((len(target), len(source)))
+        np.add.at(matrix, (rows[keep], cols[keep]), weights[keep])
+    return matrix
+
+
+def interpolation_matrix(source_wavelengths, target_wavelengths, tolerance=0.5):
+    """
+    Linear interpolation matrix of shape (target bands, source bands), computed once per pair of grids.
+    Target wavelengths may exceed the source range by tolerance nm, they are clamped to the edge band.
+    Sparse if scipy is available.
+    """
+    return _interpolation_matrix(tuple(np.round(np.asarray(source_wavelengths, dtype=float), 6)),
+                                 tuple(np.round(np.asarray(target_wavelengths, dtype=float), 6)), tolerance)
+
+
+class SpectralResampler:
+    """
+    Maps spectra and cubes from their own wavelength grid onto a common target grid.
+
+    The target grid can be a regular grid shared by different camera configurations or a subset
+    of the source bands (band selection), in which case the matrix only picks bands. Cubes are
+    resampled in row chunks with one matrix product per chunk.
+    """
+
+    def __init__(self, target_wavelengths, dtype=np.float32, chunk_rows=256):
+        self.target_wavelengths = np.asarray(target_wavelengths, dtype=float)
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+
+    def is_identity(self, source_wavelengths):
+        source_wavelengths = np.asarray(source_wavelengths, dtype=float)
+        return source_wavelengths.shape == self.target_wavelengths.shape and \
+            np.allclose(source_wavelengths, self.target_wavelengths)
+
+    def resample_spectra(self, spectra, source_wavelengths):
+        """
+        :param spectra: Array of shape (N, source bands).
+        :return: Array of shape (N, target bands).
+        """
+        spectra = np.asarray(spectra, dtype=self.dtype)
+        if self.is_identity(source_wavelengths):
+            return spectra
+
+        matrix = interpolation_matrix(source_wavelengths, self.target_wavelengths)
+        return np.asarray(matrix @ spectra.T).T.astype(self.dtype, copy=False)
+
+    def resample_cube(self, cube, source_wavelengths):
+        """
+        :param cube: Cube of shape (height, width, source bands), arrays, memory maps and ScaledCubes work.
+        :return: Cube of shape (height, width, target bands) in dtype.
+        """
+        if self.is_identity(source_wavelengths):
+            return cube
+
+        height, width, bands = cube.shape
+        matrix = interpolation_matrix(source_wavelengths, self.target_wavelengths)
+        out = np.empty((height, width, len(self.target_wavelengths)), dtype=self.dtype)
+
+        for start in range(0, height, self.chunk_rows):
+            stop = min(start + self.chunk_rows, height)
+            chunk = np.asarray(cube[start:stop], dtype=self.dtype).reshape(-1, bands)
+            out[start:stop] = np.asarray(matrix @ chunk.T).T.reshape(stop - start, width, -1)
+
+        return out
@@ -0,0 +1,208 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+# Bins for reflectance, spectra on another scale (raw counts, 1/10000 units) need their own edges
+DEFAULT_EDGES = np.linspace(0, 2, 401)
+
+
+class SpectrumAccumulator:
+    """
+    Streaming per-band statistics of spectra.
+
+    Mean and variance are accumulated with the parallel Welford update, so accumulators of
+    different chunks or files can be merged without revisiting the data. Quantiles are read
+    from fixed-bin histograms per band, their resolution is the bin width of edges. Values
+    outside of edges are counted in under- and overflow bins, see out_of_range. Quantiles that
+    fall into these bins are unknown, they are NaN and a warning is issued.
+    """
+
+    def __init__(self, n_bands, edges=DEFAULT_EDGES):
+        self.edges = np.asarray(edges, dtype=float)
+        self.count = 0
+        self.mean = np.zeros(n_bands)
+        self.m2 = np.zeros(n_bands)
+        self.histogram = np.zeros((n_bands, len(self.edges) + 1), dtype=np.int64)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def update(self, spectra):
+        """
+        :param spectra: Array of shape (N, bands), spectra containing NaN are ignored.
+        """
+        spectra = np.asarray(spectra, dtype=float)
+        spectra = spectra[~np.isnan(spectra).any(axis=1)]
+        if len(spectra) == 0:
+            return
+
+        batch_mean = spectra.mean(axis=0)
+        self._combine(len(spectra), batch_mean, ((spectra - batch_mean) ** 2).sum(axis=0))
+
+        # One bincount over flattened (band, bin) indices updates all histograms at once
+        n_bins = self.histogram.shape[1]
+        bins = np.searchsorted(self.edges, spectra, side='right') + np.arange(spectra.shape[1]) * n_bins
+        self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def merge(self, other):
+        self._combine(other.count, other.mean, other.m2)
+        self.histogram += other.histogram
+
+    @property
+    def out_of_range(self):
+        """
+        Number of values per band below the first or above the last edge.
+        """
+        return self.histogram[:, 0] + self.histogram[:, -1]
+
+    def std(self, ddof=1):
+        if self.count <= ddof:
+            return np.full_like(self.mean, np.nan)
+        return np.sqrt(self.m2 / (self.count - ddof))
+
+    def quantiles(self, qs):
+        """
+        :return: Array of shape (len(qs), bands), interpolated linearly within the histogram bins.
+        """
+        if self.count == 0:
+            return np.full((len(qs), len(self.mean)), np.nan)
+
+        # Under- and overflow bins are treated as having the width of their neighbours
+        width = np.diff(self.edges)
+        lower_edges = np.concatenate([[self.edges[0] - width[0]], self.edges])
+        upper_edges = np.concatenate([self.edges, [self.edges[-1] + width[-1]]])
+
+        cumulative = np.cumsum(self.histogram, axis=1)
+        result = np.empty((len(qs), len(self.mean)))
+        for i, q in enumerate(qs):
+            target = q * self.count
+            bins = np.minimum((cumulative < target).sum(axis=1), self.histogram.shape[1] - 1)
+            before = np.where(bins > 0, cumulative[np.arange(len(bins)), bins - 1], 0)
+            in_bin = np.maximum(self.histogram[np.arange(len(bins)), bins], 1)
+            fraction = np.clip((target - before) / in_bin, 0, 1)
+            result[i] = lower_edges[bins] + fraction * (upper_edges[bins] - lower_edges[bins])
+
+            # The values in the under- and overflow bins are only counted, their quantiles can't be placed
+            overflow = (bins == 0) | (bins == self.histogram.shape[1] - 1)
+            result[i, overflow] = np.nan
+
+        out_of_range = int(self.out_of_range.sum())
+        if out_of_range:
+            warnings.warn(f"{out_of_range} values are outside of the histogram edges {self.edges[0]:g} - "
+                          f"{self.edges[-1]:g}, quantiles falling outside of them are NaN. Pass edges that "
+                          f"cover the range of the spectra.", RuntimeWarning, stacklevel=2)
+
+        return result
+
+
+class GroupedSpectralStats:
+    """
+    Per-group (e.g. annotation_type, body_part, patient_id) spectral statistics over a wide spectra matrix.
+
+    Spectra can be added in chunks, from several files or from parallel workers whose results are
+    merged, memory only depends on the number of groups.
+    """
+
+    def __init__(self, wavelengths, group_by=('annotation_type',), edges=DEFAULT_EDGES):
+        self.wavelengths = np.asarray(wavelengths)
+        self.group_by = list(group_by)
+        self.edges = edges
+        self.groups = {}
+
+    def _accumulator(self, key):
+        if key not in self.groups:
+            self.groups[key] = SpectrumAccumulator(len(self.wavelengths), self.edges)
+        return self.groups[key]
+
+    def update(self, meta, spectra):
+        """
+        :param meta: DataFrame with the group_by columns, one row per spectrum.
+        :param spectra: Array of shape (N, bands).
+        """
+        spectra = np.asarray(spectra)
+        for key, rows in meta.groupby(self.group_by, observed=True, sort=False).indices.items():
+            key = key if isinstance(key, tuple) else (key,)
+            self._accumulator(key).update(spectra[rows])
+        return self
+
+    def update_dataframe(self, df, spectra_columns):
+        return self.update(df[self.group_by], df[spectra_columns].to_numpy())
+
+    def merge(self, other):
+        for key, accumulator in other.groups.items():
+            self._accumulator(key).merge(accumulator)
+        return self
+
+    def summary(self, quantiles=(0.25, 0.5, 0.75)):
+        """
+        :return: Long DataFrame with the group columns, 'wavelength', 'count', 'mean', 'std' and one
+                 column per quantile (e.g. 'q50'), one row per group and wavelength.
+        """
+        frames = []
+        for key, accumulator in self.groups.items():
+            frame = pd.DataFrame({'wavelength': self.wavelengths,
+                                  'count': accumulator.count,
+                                  'mean': accumulator.mean,
+                                  'std': accumulator.std()})
+            for q, values in zip(quantiles, accumulator.quantiles(quantiles)):
+                frame[f'q{q * 100:g}'] = values
+            for column, value in zip(self.group_by, key):
+                frame.insert(self.group_by.index(column), column, value)
+            frames.append(frame)
+
+        if not frames:
+            return pd.DataFrame(columns=self.group_by + ['wavelength', 'count', 'mean', 'std'])
+        return pd.concat(frames, ignore_index=True)
+
+
+def summary_group_columns(summary):
+    # Everything that isn't a statistic or a quantile column (q25, q50, ...) identifies a group
+    statistics = {'wavelength', 'count', 'mean', 'std'}
+    return [column for column in summary.columns
+            if column not in statistics and not (column.startswith('q') and column[1:].replace('.', '').isdigit())]
+
+
+def plot_spectral_summary(summary, hue='annotation_type', ax=None, title='Reflectance over wavelength'):
+    """
+    Plots mean ± std per group from a precomputed summary, like sns.lineplot(errorbar='sd') without
+    recomputing the statistics from the long form.
+
+    Every combination of the group columns of the summary gets its own line, so summaries grouped by
+    several columns never mix groups in one line. The lines are ordered by hue first.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    group_columns = summary_group_columns(summary)
+    if hue is not None:
+        if hue not in group_columns:
+            raise ValueError(f"hue '{hue}' is not a group column of the summary: {group_columns}")
+        group_columns = [hue] + [column for column in group_columns if column != hue]
+
+    sns.set_theme(style="darkgrid")
+    if ax is None:
+        _, ax = plt.subplots(figsize=(14, 7))
+
+    groups = summary.groupby(group_columns, observed=True, sort=True) if group_columns else [((), summary)]
+    for key, group in groups:
+        key = key if isinstance(key, tuple) else (key,)
+        label = ', '.join(str(value) for value in key) or None
+        line, = ax.plot(group['wavelength'], group['mean'], label=label)
+        ax.fill_between(group['wavelength'], group['mean'] - group['std'], group['mean'] + group['std'],
+                        color=line.get_color(), alpha=0.2)
+
+    ax.set_xlabel('Wavelength (nm)')
+    ax.set_ylabel('Reflectance')
+    ax.set_title(title)
+    if group_columns:
+        ax.legend(title=', '.join(group_columns))
+
+    return ax
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# The tests run against the cuvis stand-in of the benchmarks, the SDK is not needed
+import fake_cuvis
+sys.modules['cuvis'] = fake_cuvis
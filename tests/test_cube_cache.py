@@ -0,0 +1,48 @@
+import os
+import time
+
+import numpy as np
+
+from cube_cache import CubeCache
+
+
+def make_sources(directory, count):
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'source_{i}.cu3s')
+        with open(path, 'wb') as source_file:
+            source_file.write(bytes([i]))
+        paths.append(path)
+    return paths
+
+
+def test_eviction_tracks_size_without_rescanning(tmp_path, monkeypatch):
+    cube = np.zeros((10, 10, 10), dtype=np.float32)
+    sources = make_sources(str(tmp_path), 4)
+    cache = CubeCache(str(tmp_path / 'cache'), max_bytes=2 * (cube.nbytes + 128))
+
+    scans = []
+    monkeypatch.setattr(cache, 'entries', lambda: scans.append(1) or [])
+    for source in sources:
+        cache.put(source, cube)
+        time.sleep(0.01)
+
+    assert not scans
+    assert cache.get(sources[0]) is None and cache.get(sources[1]) is None
+    assert cache.get(sources[3]) is not None
+    on_disk = [name for name in os.listdir(cache.cache_dir) if name.endswith('.npy')]
+    assert len(on_disk) == 2
+    assert cache.size() == sum(os.path.getsize(os.path.join(cache.cache_dir, name)) for name in on_disk)
+
+
+def test_stale_temporary_files_are_removed(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    stale, fresh = cache_dir / 'stale.npy.1.2.tmp', cache_dir / 'fresh.npy.1.2.tmp'
+    stale.write_bytes(b'partial')
+    fresh.write_bytes(b'partial')
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+    CubeCache(str(cache_dir))
+
+    assert not stale.exists() and fresh.exists()
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+
+import fake_cuvis
+import hsi_analysis
+from spectral_dataset import read_spectral_dataset
+
+
+def make_data(directory):
+    rng = np.random.default_rng(0)
+    data = {}
+    for i in range(2):
+        path = os.path.join(directory, f'Auto_{i:03d}.cu3s')
+        fake_cuvis.save_session(path, rng.integers(0, 10000, size=(40, 50, 51), dtype=np.uint16), mode='Reflectance')
+        data[f'Auto_{i:03d}'] = {j: {'image_path': path, 'patient_id': 'p1', 'body_part': 'arms',
+                                     'annotation_type': 'skin', 'coordinates': coordinates}
+                                 for j, coordinates in enumerate([(5, 5), (20, 30)])}
+
+    # Far outside of the 50 pixel wide image
+    data['Auto_000'][2] = dict(data['Auto_000'][0], coordinates=(500, 5))
+    return data
+
+
+def test_resume_after_annotation_outside_image(tmp_path):
+    data = make_data(str(tmp_path))
+    dataset = str(tmp_path / 'dataset')
+
+    assert hsi_analysis.extract_spectra_to_dataset(data, dataset, kernel_size=3, chunk_size=1) == 5
+
+    meta, spectra, _ = read_spectral_dataset(dataset)
+    outside = (np.asarray(meta['x']) == 500)
+    assert outside.sum() == 1
+    assert np.isnan(spectra[outside]).all()
+    assert not np.isnan(spectra[~outside]).any()
+
+    # Both images are recorded as completed, so the resumed run has nothing left to do
+    assert hsi_analysis.extract_spectra_to_dataset(data, dataset, kernel_size=3, chunk_size=1) == 0
+    assert len(read_spectral_dataset(dataset)[1]) == 5
+
+
+def test_extract_spectra_keeps_valid_annotations(tmp_path):
+    data = make_data(str(tmp_path))
+
+    spectra = hsi_analysis.extract_spectra(data, kernel_size=3)
+    assert spectra.shape == (5, 51)
+    assert np.isnan(spectra[2]).all()
+    assert not np.isnan(np.delete(spectra, 2, axis=0)).any()
+
+
+def test_feature_values_of_annotation_outside_image(tmp_path):
+    data = make_data(str(tmp_path))
+
+    df = hsi_analysis.extract_feature_values(data, kernel_size=3)
+    features = df.columns[len(hsi_analysis.META_COLUMNS):]
+    assert len(df) == 5 and len(features) > 0
+
+    outside = df['x'] == 500
+    assert outside.sum() == 1
+    assert df.loc[outside, features].isna().all(axis=None)
+    assert df.loc[~outside, 'ratio_800_650'].notna().all()
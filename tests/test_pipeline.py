@@ -0,0 +1,50 @@
+import os
+import sys
+import csv
+
+import numpy as np
+
+import fake_cuvis
+import pipeline
+from spectral_dataset import read_spectral_dataset
+
+
+def run(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['pipeline.py'] + list(args))
+    pipeline.main()
+
+
+def test_failed_calibration_is_left_out_of_the_dataset(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    image_dir = tmp_path / 'images'
+    rows = []
+    for i in range(3):
+        directory = image_dir / f'p{i}' / 'arms'
+        os.makedirs(directory)
+        path = str(directory / f'Auto_{i:03d}.cu3s')
+        rows.append([f'Auto_{i:03d}', 5, 6, 'skin', 'arms', f'p{i}'])
+        fake_cuvis.save_session(path, rng.integers(100, 4000, size=(20, 20, 51), dtype=np.uint16))
+
+    fake_cuvis.save_session(str(tmp_path / 'dark.cu3s'), np.full((20, 20, 51), 100, dtype=np.uint16))
+    fake_cuvis.save_session(str(tmp_path / 'white.cu3s'), np.full((20, 20, 51), 4100, dtype=np.uint16))
+    with open(tmp_path / 'annotations.csv', 'w', newline='') as csv_file:
+        csv.writer(csv_file).writerows(rows)
+
+    # The raw image stays readable, only its calibration fails
+    calibrate_worker = pipeline.calibrate_worker
+
+    def failing_worker(paths, *args):
+        failed = [path for path, _ in paths if 'Auto_001' in path]
+        return failed + calibrate_worker([pair for pair in paths if pair[0] not in failed], *args)
+
+    monkeypatch.setattr(pipeline, 'calibrate_worker', failing_worker)
+
+    run(monkeypatch, '--image-dir', str(image_dir), '--annotations', str(tmp_path / 'annotations.csv'),
+        '--work-dir', str(tmp_path / 'run'), '--stages', 'discover', 'map', 'calibrate', 'extract',
+        '--dark', str(tmp_path / 'dark.cu3s'), '--white', str(tmp_path / 'white.cu3s'), '--engine', 'numpy',
+        '--workers', '2')
+
+    meta, spectra, _ = read_spectral_dataset(str(tmp_path / 'run' / 'dataset'))
+    assert sorted(meta['image_name']) == ['Auto_000', 'Auto_002']
+    # Only reflectance, never the raw counts of the image that failed
+    assert np.nanmax(spectra) <= 1
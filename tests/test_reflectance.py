@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import fake_cuvis
+from hsi_processor import HSIProcessor
+from reflectance import ReflectanceCalibrator
+
+
+def make_references(rng, shape=(30, 20, 8)):
+    dark = rng.integers(50, 150, size=shape).astype(np.uint16)
+    white = dark + rng.integers(1000, 4000, size=shape).astype(np.uint16)
+    raw = dark + rng.integers(0, 4000, size=shape).astype(np.uint16)
+    return raw, dark, white
+
+
+def expected_reflectance(raw, dark, white):
+    return (raw.astype(np.float64) - dark) / (white.astype(np.float64) - dark)
+
+
+@pytest.mark.parametrize('chunk_rows', [None, 1, 7, 30, 100])
+def test_apply_matches_formula(chunk_rows):
+    raw, dark, white = make_references(np.random.default_rng(0))
+
+    reflectance = ReflectanceCalibrator(dark, white).apply(raw, chunk_rows=chunk_rows)
+
+    assert reflectance.dtype == np.float32
+    np.testing.assert_allclose(reflectance, expected_reflectance(raw, dark, white), rtol=1e-5)
+
+
+def test_apply_inplace_and_spectrum_references():
+    raw, dark, white = make_references(np.random.default_rng(1))
+    dark, white = dark[0, 0], white[0, 0]
+    cube = raw.astype(np.float32)
+
+    reflectance = ReflectanceCalibrator(dark, white).apply(cube, inplace=True, chunk_rows=4)
+
+    assert reflectance is cube
+    np.testing.assert_allclose(cube, expected_reflectance(raw, dark, white), rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        ReflectanceCalibrator(dark, white).apply(raw, inplace=True)
+
+
+def test_zero_denominator_gives_zero():
+    raw, dark, white = make_references(np.random.default_rng(2))
+    white[3, 4] = dark[3, 4]
+    white[10, :, 2] = dark[10, :, 2]
+
+    reflectance = ReflectanceCalibrator(dark, white).apply(raw, chunk_rows=6)
+
+    assert np.isfinite(reflectance).all()
+    assert (reflectance[3, 4] == 0).all() and (reflectance[10, :, 2] == 0).all()
+    valid = white != dark
+    np.testing.assert_allclose(reflectance[valid], expected_reflectance(raw[valid], dark[valid], white[valid]),
+                               rtol=1e-5)
+
+
+def test_numpy_batch_matches_formula(tmp_path):
+    raw, dark, white = make_references(np.random.default_rng(3))
+    paths = {}
+    for name, cube in [('dark', dark), ('white', white), ('raw', raw)]:
+        paths[name] = str(tmp_path / f'{name}.cu3s')
+        fake_cuvis.save_session(paths[name], cube)
+    with open(tmp_path / 'broken.cu3s', 'wb') as broken_file:
+        broken_file.write(b'not a measurement')
+
+    processor = HSIProcessor()
+    results = dict(processor.raw2reflectance_batch([paths['raw'], str(tmp_path / 'broken.cu3s')], paths['dark'],
+                                                   paths['white'], engine='numpy', chunk_rows=8))
+
+    assert results[str(tmp_path / 'broken.cu3s')] is None
+    np.testing.assert_allclose(results[paths['raw']], expected_reflectance(raw, dark, white), rtol=1e-5)
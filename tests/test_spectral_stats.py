@@ -0,0 +1,50 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import hsi_analysis
+from spectral_stats import SpectrumAccumulator
+
+
+def test_quantiles_match_percentile():
+    spectra = np.random.default_rng(0).uniform(0.1, 0.9, size=(5000, 4))
+
+    accumulator = SpectrumAccumulator(4)
+    for chunk in np.array_split(spectra, 7):
+        accumulator.update(chunk)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        quantiles = accumulator.quantiles((0.25, 0.5, 0.75))
+
+    # Linear interpolation within bins of width 0.005
+    np.testing.assert_allclose(quantiles, np.percentile(spectra, (25, 50, 75), axis=0), atol=0.005)
+    assert not accumulator.out_of_range.any()
+
+
+def test_out_of_range_values_warn_instead_of_clipping():
+    spectra = np.random.default_rng(1).uniform(1000, 3000, size=(2000, 3))
+
+    accumulator = SpectrumAccumulator(3)
+    accumulator.update(spectra)
+    assert (accumulator.out_of_range == 2000).all()
+
+    with pytest.warns(RuntimeWarning, match='outside of the histogram edges'):
+        quantiles = accumulator.quantiles((0.5,))
+    assert np.isnan(quantiles).all()
+
+
+def test_grouped_statistics_with_custom_edges():
+    rng = np.random.default_rng(2)
+    spectra = rng.uniform(0, 10000, size=(40000, 3))
+    df = pd.DataFrame(spectra, columns=[500, 600, 700])
+    df.insert(0, 'annotation_type', np.where(np.arange(40000) % 2, 'skin', 'lesion'))
+
+    stats = hsi_analysis.grouped_spectral_statistics(df, edges=np.linspace(0, 10000, 2001))
+    summary = stats.summary().set_index(['annotation_type', 'wavelength'])
+
+    for annotation_type, rows in (('skin', spectra[1::2]), ('lesion', spectra[::2])):
+        expected = np.percentile(rows, 50, axis=0)
+        np.testing.assert_allclose(summary.loc[annotation_type]['q50'].to_numpy(), expected, atol=5)
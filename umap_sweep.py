@@ -0,0 +1,96 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def compute_knn(features, n_neighbors, metric, random_state=None):
+    """
+    Computes the nearest neighbour graph UMAP builds internally, so it can be shared between fits.
+
+    :return: Tuple of the knn indices and distances.
+    """
+    from sklearn.utils import check_random_state
+    from umap.umap_ import nearest_neighbors
+
+    knn_indices, knn_dists, _ = nearest_neighbors(features, n_neighbors, metric, {}, False,
+                                                  check_random_state(random_state))
+    return knn_indices, knn_dists
+
+
+def _fit_embedding(features, knn, n_neighbors, min_dist, metric, random_state):
+    import umap
+
+    # Without a search index the reducer can't transform new data, which the sweep doesn't need
+    reducer = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric=metric, random_state=random_state,
+                        precomputed_knn=(knn[0], knn[1], None))
+    return reducer.fit_transform(features)
+
+
+def save_embedding_plot(embedding, labels, path, title, legend_title='Body part'):
+    import matplotlib
+    import seaborn as sns
+    from matplotlib.figure import Figure
+
+    # Figures are drawn without pyplot, so nothing blocks and no display is needed
+    with matplotlib.rc_context(sns.axes_style('darkgrid')):
+        fig = Figure(figsize=(10, 6))
+        ax = fig.add_subplot()
+        for label in sorted(set(labels)):
+            indices = labels == label
+            ax.scatter(embedding[indices, 0], embedding[indices, 1], label=label)
+        ax.set_title(title)
+        ax.legend(title=legend_title, loc='upper left')
+        fig.savefig(path)
+
+
+def umap_sweep(features, labels=None, out_dir=None, metrics=('correlation',), n_neighbors=(5, 10, 20),
+               min_dists=(0.1, 0.15, 0.25, 0.5, 0.8), workers=None, random_state=None, legend_title='Body part'):
+    """
+    Fits UMAP embeddings over a grid of hyperparameters.
+
+    The nearest neighbour graph only depends on n_neighbors and the metric, it is computed once
+    per pair and reused for every min_dist. The fits run in a process pool.
+
+    :param features: Array of shape (N, features).
+    :param labels: Optional array of N labels used to color the saved plots.
+    :param out_dir: Directory for the embeddings (.npy) and plots (.png), nothing is saved if None.
+    :param workers: Number of worker processes, defaults to the number of CPUs. 1 fits in this process.
+    :return: Dictionary mapping (metric, n_neighbors, min_dist) to the embedding.
+    """
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+    if labels is not None:
+        labels = np.asarray(labels)
+
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    futures = {}
+    embeddings = {}
+    try:
+        for metric in metrics:
+            for n in n_neighbors:
+                knn = compute_knn(features, n, metric, random_state=random_state)
+                for d in min_dists:
+                    args = (features, knn, n, d, metric, random_state)
+                    if executor is None:
+                        embeddings[(metric, n, d)] = _fit_embedding(*args)
+                    else:
+                        futures[(metric, n, d)] = executor.submit(_fit_embedding, *args)
+
+        for params, future in futures.items():
+            embeddings[params] = future.result()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if out_dir is not None:
+        for (metric, n, d), embedding in embeddings.items():
+            name = f'umap_{metric}_n{n}_d{d}'
+            np.save(os.path.join(out_dir, name + '.npy'), embedding)
+            if labels is not None:
+                save_embedding_plot(embedding, labels, os.path.join(out_dir, name + '.png'),
+                                    f'UMAP plot, metric={metric}, n={n}, d={d}', legend_title=legend_title)
+
+    return embeddings
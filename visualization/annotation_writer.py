@@ -0,0 +1,130 @@
+import os
+import csv
+import json
+import time
+import queue
+import threading
+
+
+# Column order of read_annotations / map_annotations_to_images, region holds the geometry of region annotations
+ANNOTATION_COLUMNS = ['image_name', 'x', 'y', 'annotation_type', 'body_part', 'patient_id', 'region']
+
+_STOP = object()
+
+
+def read_annotation_records(path):
+    """
+    Reads an annotation file written by AnnotationWriter.
+
+    :return: List of annotation dictionaries with the keys of ANNOTATION_COLUMNS, coordinates as int and
+             the region geometry decoded, or an empty list if the file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path, 'r', newline='') as csv_file:
+        for row in csv.DictReader(csv_file, fieldnames=ANNOTATION_COLUMNS):
+            if row['image_name'] == ANNOTATION_COLUMNS[0]:
+                continue  # Header
+            row['x'], row['y'] = int(row['x']), int(row['y'])
+            row['region'] = json.loads(row['region']) if row['region'] else None
+            records.append(row)
+
+    return records
+
+
+class AnnotationWriter:
+    """
+    Appends annotations to a CSV file from a background thread.
+
+    Records are queued by add and written in batches, so saving an annotation never waits for the
+    disk. The file is append-only with the fixed columns of ANNOTATION_COLUMNS and can be read with
+    read_annotation_records or read_annotations.
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.error = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='annotation-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, image_name, x, y, annotation_type, body_part, patient_id, region=None):
+        if self.error is not None:
+            raise self.error
+        if not self._thread.is_alive():
+            raise RuntimeError("Annotation writer is closed")
+
+        self._queue.put({'image_name': image_name, 'x': int(x), 'y': int(y), 'annotation_type': annotation_type,
+                         'body_part': body_part, 'patient_id': patient_id,
+                         'region': json.dumps(region) if region is not None else ''})
+
+    def flush(self):
+        """
+        Blocks until all queued annotations are written.
+        """
+        self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _next_batch(self):
+        # A batch is written at most flush_interval after its first record was taken off the queue
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _open(self):
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        csv_file = open(self.path, 'a', newline='')
+        writer = csv.DictWriter(csv_file, fieldnames=ANNOTATION_COLUMNS)
+        if write_header:
+            writer.writeheader()
+            csv_file.flush()
+        return csv_file, writer
+
+    def _run(self):
+        try:
+            csv_file, writer = self._open()
+        except OSError as e:
+            self.error = e
+            csv_file = writer = None
+
+        stopped = False
+        while not stopped:
+            batch = self._next_batch()
+            records = [record for record in batch if record is not _STOP]
+            stopped = len(records) < len(batch)
+
+            try:
+                # After an error the remaining records are only taken off the queue, so flush doesn't block
+                if self.error is None:
+                    writer.writerows(records)
+                    csv_file.flush()
+            except OSError as e:
+                self.error = e
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+        if csv_file is not None:
+            csv_file.close()
@@ -0,0 +1,97 @@
+import threading
+
+import numpy as np
+
+
+class DisplayPyramid:
+    """
+    Downsampled versions of all channels of a cube for display.
+
+    Level 0 is the cube itself, every further level halves height and width by averaging 2x2
+    pixels, down to about min_size pixels on the longer side. Levels are stored band-major, so
+    a channel is one contiguous image. Per-channel contrast limits are taken as percentiles of
+    the coarsest level. The levels are built in a background thread, until a level is ready the
+    next finer one is used.
+    """
+
+    def __init__(self, cube, min_size=256, percentiles=(1, 99), chunk_rows=256, on_ready=None):
+        self.cube = cube
+        self.percentiles = percentiles
+        self.chunk_rows = chunk_rows
+        self.on_ready = on_ready
+
+        height, width = cube.shape[:2]
+        self.n_levels = 1
+        while max(height, width) >> self.n_levels >= min_size:
+            self.n_levels += 1
+
+        self.levels = {}
+        self.clims = None
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._build, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _downsample(level):
+        bands, height, width = level.shape
+        level = level[:, :height // 2 * 2, :width // 2 * 2]
+        return level.reshape(bands, height // 2, 2, width // 2, 2).mean(axis=(2, 4), dtype=np.float32)
+
+    def _first_level(self):
+        # Read the full resolution cube in row chunks, so it is never converted as a whole
+        height, width, bands = self.cube.shape
+        chunk_rows = max(self.chunk_rows // 2 * 2, 2)
+        level = np.empty((bands, height // 2, width // 2), dtype=np.float32)
+
+        for start in range(0, height // 2 * 2, chunk_rows):
+            if self._cancelled:
+                return None
+            stop = min(start + chunk_rows, height // 2 * 2)
+            chunk = np.asarray(self.cube[start:stop, :width // 2 * 2, :], dtype=np.float32)
+            level[:, start // 2:stop // 2, :] = self._downsample(np.moveaxis(chunk, 2, 0))
+
+        return level
+
+    def _build(self):
+        level = None
+        for n in range(1, self.n_levels):
+            level = self._first_level() if level is None else self._downsample(level)
+            if level is None or self._cancelled:
+                return
+            with self._lock:
+                self.levels[n] = level
+
+        coarsest = level if level is not None else np.moveaxis(np.asarray(self.cube, dtype=np.float32), 2, 0)
+        limits = np.nanpercentile(coarsest.reshape(coarsest.shape[0], -1), self.percentiles, axis=1)
+        with self._lock:
+            self.clims = limits.T
+
+        if self.on_ready is not None and not self._cancelled:
+            self.on_ready()
+
+    def level_for(self, view_pixels, display_pixels):
+        """
+        :param view_pixels: Number of full resolution pixels visible along the longer axis.
+        :param display_pixels: Number of screen pixels available for them.
+        :return: The coarsest level that still has at least one pixel per screen pixel.
+        """
+        if display_pixels <= 0 or view_pixels <= display_pixels:
+            return 0
+        return int(min(np.floor(np.log2(view_pixels / display_pixels)), self.n_levels - 1))
+
+    def channel(self, channel, level=0):
+        with self._lock:
+            # Fall back to the next finer level that is already built
+            while level > 0 and level not in self.levels:
+                level -= 1
+            if level == 0:
+                return self.cube[:, :, channel], 0
+            return self.levels[level][channel], level
+
+    def clim(self, channel):
+        with self._lock:
+            return None if self.clims is None else tuple(self.clims[channel])
+
+    def cancel(self):
+        self._cancelled = True
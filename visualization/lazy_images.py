@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LazyImageList:
+    """
+    Sequence of hyperspectral images that are decoded on first access.
+
+    Only the most recently used images (the current one plus its neighbours) are kept in
+    memory. Neighbours of the current image can be decoded ahead in a background thread,
+    so stepping to the next or previous image does not wait for the decoder. The processor is
+    shared by the caller and the background thread, its load_array calls are serialised.
+    """
+
+    def __init__(self, file_list, processor, neighbours=1):
+        self.file_list = list(file_list)
+        self.processor = processor
+        self.neighbours = neighbours
+        self.capacity = 2 * neighbours + 1
+
+        self._cache = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.file_list)
+        if not 0 <= index < len(self.file_list):
+            raise IndexError(f"Image index {index} out of range")
+
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+            future = self._pending.get(index)
+
+        if future is not None:
+            return future.result()
+
+        return self._load(index)
+
+    def _load(self, index):
+        try:
+            with self._load_lock:
+                # The image may have been loaded while waiting for the processor
+                with self._lock:
+                    hsi = self._cache.get(index)
+                if hsi is None:
+                    hsi = self.processor.load_array(self.file_list[index])
+        finally:
+            with self._lock:
+                self._pending.pop(index, None)
+
+        with self._lock:
+            self._cache[index] = hsi
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+
+        return hsi
+
+    def prefetch(self, index):
+        """
+        Starts decoding the neighbours of index in the background.
+        """
+        for offset in range(1, self.neighbours + 1):
+            for neighbour in (index + offset, index - offset):
+                if not 0 <= neighbour < len(self.file_list):
+                    continue
+                with self._lock:
+                    if neighbour in self._cache or neighbour in self._pending:
+                        continue
+                    self._pending[neighbour] = self._executor.submit(self._load, neighbour)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
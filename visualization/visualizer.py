@@ -1,16 +1,28 @@
 import sys
 import os
-import glob
+import threading
 
+import numpy as np
 import matplotlib.pyplot as plt
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QSlider, QLabel, QVBoxLayout, QWidget, QPushButton
-from PyQt5.QtWidgets import QDialog, QLineEdit, QMessageBox
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QLineEdit, QMessageBox, QComboBox
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.widgets import RectangleSelector, PolygonSelector
 
 
 from hsi_processor import HSIProcessor
+from discovery import discover_cu3s_files
+from visualization.lazy_images import LazyImageList
+from visualization.display_pyramid import DisplayPyramid
+from visualization.annotation_writer import AnnotationWriter, read_annotation_records
+from region_statistics import rectangle_mask, polygon_mask, brush_mask, region_statistics
+from spectral_features import FeatureEngine
+
+
+SELECTION_MODES = ['Point', 'Rectangle', 'Polygon', 'Brush']
 
 
 class AnnotationDialog(QDialog):
@@ -41,24 +53,39 @@ class AnnotationDialog(QDialog):
 
 
 class HSIViewer(QMainWindow):
-    def __init__(self, file_list, annotation_dir=""):
+    # Emitted from the pyramid and feature threads, delivered on the GUI thread
+    pyramid_ready = pyqtSignal()
+    feature_maps_ready = pyqtSignal(int, object)
+
+    def __init__(self, file_list, annotation_dir="", processor_kwargs=None, neighbours=1):
         super().__init__()
-        self.hsi_processor = HSIProcessor()
+        self.hsi_processor = HSIProcessor(**(processor_kwargs or {}))
         self.file_list = file_list
-        self.images = self.load_images(file_list)  # List of hyperspectral images
+        self.images = self.load_images(file_list, neighbours)  # Lazily decoded hyperspectral images
         self.wavelengths = self.hsi_processor.get_wavelengths()
         self.current_image_index = 0  # Index of the current image being viewed
         self.last_clicked_point = None
         self.annotation_dir = annotation_dir
+        self.load_annotations()
+        self.pyramid = None
+        self.pyramid_index = None
+        self.feature_engine = FeatureEngine(self.wavelengths)
+        self.feature_maps = None  # (image index, maps or None while computing, colour limits) of the current image
+        self.display_feature = None
         self.initUI()
 
-    def load_images(self, file_list):
-        hsi_list = []
-        for file in file_list:
-            measurement,_ = self.hsi_processor.load_measurement(file)
-            hsi  =self.hsi_processor.measurement_2_arr(measurement)
-            hsi_list.append(hsi)
-        return hsi_list
+    def load_annotations(self):
+        # Saved annotations are shown on their images, new ones are appended by a background writer
+        self.annotation_path = os.path.join(self.annotation_dir, 'annotations.csv')
+        self.annotations = {}
+        for record in read_annotation_records(self.annotation_path):
+            self.annotations.setdefault(record['image_name'], []).append(record)
+        self.annotation_writer = AnnotationWriter(self.annotation_path)
+
+    def load_images(self, file_list, neighbours=1):
+        images = LazyImageList(file_list, self.hsi_processor, neighbours=neighbours)
+        images.prefetch(0)
+        return images
 
     def initUI(self):
         self.setWindowTitle('Hyperspectral Image Viewer')
@@ -68,6 +95,25 @@ class HSIViewer(QMainWindow):
         self.figure, (self.ax, self.spectrum_ax) = plt.subplots(1, 2, figsize=(12, 6))  # Two subplots
         self.canvas = FigureCanvas(self.figure)
         self.canvas.mpl_connect('button_press_event', self.on_click)
+        self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        self.canvas.mpl_connect('button_release_event', self.on_release)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.toolbar = NavigationToolbar(self.canvas, self)
+        self.init_artists()
+        self.init_selectors()
+
+        # Slider events are coalesced, only the latest channel is rendered once the event loop is idle
+        self.pending_channel = 0
+        self.render_timer = QTimer(self)
+        self.render_timer.setSingleShot(True)
+        self.render_timer.setInterval(0)
+        self.render_timer.timeout.connect(self.render_pending_channel)
+
+        # Zooming and finished pyramid levels re-render the current channel at a matching resolution
+        self.pyramid_ready.connect(self.schedule_render)
+        self.feature_maps_ready.connect(self.set_feature_maps)
+        self.ax.callbacks.connect('xlim_changed', lambda ax: self.schedule_render())
+        self.ax.callbacks.connect('ylim_changed', lambda ax: self.schedule_render())
 
         # Slider for selecting channels
         self.slider = QSlider(self)
@@ -89,16 +135,32 @@ class HSIViewer(QMainWindow):
         self.file_name_label = QLabel(self)
         self.file_name_label.setAlignment(Qt.AlignCenter)
 
+        # Selection mode for points and regions
+        self.mode_box = QComboBox(self)
+        self.mode_box.addItems(SELECTION_MODES)
+        self.mode_box.currentTextChanged.connect(self.set_selection_mode)
+
+        # Display of the selected channel or a feature map of the whole image
+        self.display_box = QComboBox(self)
+        self.display_box.addItems(['Channel'] + self.feature_engine.names())
+        self.display_box.currentTextChanged.connect(self.set_display)
+        if self.feature_engine.unavailable:
+            self.statusBar().showMessage('Feature maps not covered by the wavelengths: '
+                                         + ', '.join(self.feature_engine.unavailable))
+
         # Create a Save Coordinates Button
         self.save_coord_button = QPushButton('Save Coordinates', self)
         self.save_coord_button.clicked.connect(self.save_coordinates)
 
         # Layout
         layout = QVBoxLayout()
+        layout.addWidget(self.toolbar)
         layout.addWidget(self.canvas)
         layout.addWidget(self.label)
         layout.addWidget(self.coord_label)
         layout.addWidget(self.slider)
+        layout.addWidget(self.mode_box)
+        layout.addWidget(self.display_box)
         layout.addWidget(self.save_coord_button)
 
         # Buttons for navigating images
@@ -117,53 +179,335 @@ class HSIViewer(QMainWindow):
         self.setCentralWidget(container)
         self.update_plot(0)
         self.update_file_name_label()
+        self.update_annotation_overlay()
+
+    def init_artists(self):
+        # Artists are created once and only get new data on updates
+        current_image = self.images[self.current_image_index]
+        self.image_artist = self.ax.imshow(current_image[:, :, 0], cmap='gray')
+        self.image_shape = current_image.shape[:2]
+        # Limits are managed by update_plot, so switching pyramid levels doesn't reset the zoom
+        self.ax.set_autoscale_on(False)
+
+        # The click marker and everything in the spectrum plot that follows clicks is animated and blitted
+        self.marker = plt.Rectangle((0, 0), 1, 1, edgecolor='red', facecolor='none', animated=True, visible=False)
+        self.ax.add_patch(self.marker)
+
+        # Saved annotations of the current image only change on image switches and saves
+        self.annotation_artist = self.ax.scatter([], [], marker='x', color='cyan')
+
+        self.spectrum_line, = self.spectrum_ax.plot(self.wavelengths, np.zeros(len(self.wavelengths)),
+                                                    animated=True, visible=False)
+        self.wavelength_line = self.spectrum_ax.axvline(x=self.wavelengths[0], color='red', linestyle='--',
+                                                        animated=True, visible=False)
+        self.wavelength_text = self.spectrum_ax.text(self.wavelengths[0], 0, '', color='red', animated=True,
+                                                     visible=False)
+        self.spectrum_ax.title.set_animated(True)
+
+        self.spectrum_ax.set_xlim([self.wavelengths[0], self.wavelengths[-1]])
+        self.spectrum_ax.set_ylim([0,1])
+        self.spectrum_ax.set_xlabel('Wavelength (nm)')
+        self.spectrum_ax.set_ylabel('Reflectance')
+
+        # Selected regions are shown as an overlay, their spectrum as mean line with a std band
+        self.region_artist = self.ax.imshow(np.zeros((1, 1)), cmap='autumn', alpha=0.4, vmin=0, vmax=1,
+                                            animated=True, visible=False)
+        self.brush_line, = self.ax.plot([], [], color='red', linewidth=2, animated=True, visible=False)
+        self.spread_artist = None
+
+        self.animated_artists = [self.marker, self.region_artist, self.brush_line, self.spectrum_line,
+                                 self.wavelength_line, self.wavelength_text, self.spectrum_ax.title]
+        self.background = None
+
+    def init_selectors(self):
+        self.selection_mode = 'Point'
+        self.region = None
+        self.region_stats = None
+        self.brush_points = None
+        self.brush_radius = 3
+
+        self.rectangle_selector = RectangleSelector(self.ax, self.on_rectangle, useblit=True)
+        self.rectangle_selector.set_active(False)
+        self.polygon_selector = PolygonSelector(self.ax, self.on_polygon, useblit=True)
+        self.polygon_selector.set_active(False)
+
+    def set_selection_mode(self, mode):
+        self.selection_mode = mode
+        self.rectangle_selector.set_active(mode == 'Rectangle')
+        self.polygon_selector.set_active(mode == 'Polygon')
+        if mode != 'Polygon':
+            self.polygon_selector.clear()
+
+    def set_display(self, name):
+        self.display_feature = None if name == 'Channel' else name
+        self.update_plot(self.slider.value())
+
+    def compute_feature_maps(self, index, cube):
+        try:
+            maps = self.feature_engine.compute(cube)
+        except Exception as e:
+            maps = e
+        self.feature_maps_ready.emit(index, maps)
+
+    def set_feature_maps(self, index, maps):
+        # Results of an image that was left while they were computed are dropped
+        if self.feature_maps is None or self.feature_maps[0] != index:
+            return
+        if isinstance(maps, Exception):
+            self.feature_maps = None
+            self.display_box.setCurrentIndex(0)
+            QMessageBox.warning(self, "Feature Maps Not Computed", f"Could not compute the feature maps: {maps}")
+            return
+        self.feature_maps = (index, maps, {})
+        self.schedule_render()
+
+    def get_feature_map(self, name):
+        """
+        :return: Tuple of the feature map and its colour limits, or None while the maps are computed.
+        """
+        # All maps of an image are computed in one pass in a background thread when the first one is shown,
+        # until then the channel is displayed
+        if self.feature_maps is None or self.feature_maps[0] != self.current_image_index:
+            self.feature_maps = (self.current_image_index, None, {})
+            threading.Thread(target=self.compute_feature_maps,
+                             args=(self.current_image_index, self.images[self.current_image_index]),
+                             daemon=True).start()
+
+        _, maps, clims = self.feature_maps
+        if maps is None:
+            return None
+        if name not in clims:
+            # Indices can have outliers where the reflectance is close to zero, the limits ignore them
+            finite = maps[name][np.isfinite(maps[name])]
+            clims[name] = tuple(np.percentile(finite, (2, 98))) if finite.size else (0, 1)
+        return maps[name], clims[name]
 
     def changeValue(self, value):
-        self.update_plot(value)
         self.label.setText(f'Channel: {value}')
+        self.schedule_render()
+
+    def schedule_render(self):
+        self.pending_channel = self.slider.value()
+        if not self.render_timer.isActive():
+            self.render_timer.start()
+
+    def render_pending_channel(self):
+        self.update_plot(self.pending_channel)
 
     def on_click(self, event):
-        if event.xdata is not None and event.ydata is not None:
-            x, y = int(event.xdata), int(event.ydata)
+        if self.toolbar.mode:
+            return  # Clicks belong to zooming or panning
+        if event.inaxes is not self.ax or event.xdata is None or event.ydata is None:
+            return
+
+        x, y = int(event.xdata), int(event.ydata)
+        if self.selection_mode == 'Point':
             self.coord_label.setText(f'Coordinates: (X: {x}, Y: {y})')
             self.last_clicked_point = (x, y)  # Store the last clicked point
-            self.update_plot(self.slider.value())  # Update the plot with the new point
+            self.region = None
+
+            # Only the animated artists change, the image is not redrawn
+            self.update_spectrum(self.slider.value())
+            self.blit()
+        elif self.selection_mode == 'Brush':
+            self.brush_points = [(event.xdata, event.ydata)]
+
+    def on_motion(self, event):
+        if self.brush_points is None or event.inaxes is not self.ax or event.xdata is None:
+            return
+        self.brush_points.append((event.xdata, event.ydata))
+        self.brush_line.set_data(*zip(*self.brush_points))
+        self.brush_line.set_visible(True)
+        self.blit()
+
+    def on_release(self, event):
+        if self.brush_points is None:
+            return
+        points, self.brush_points = self.brush_points, None
+        self.brush_line.set_visible(False)
+        mask = brush_mask(self.image_shape, points, radius=self.brush_radius)
+        self.set_region('brush', {'points': points, 'radius': self.brush_radius}, mask)
+
+    def on_rectangle(self, eclick, erelease):
+        x0, x1, y0, y1 = self.rectangle_selector.extents
+        mask = rectangle_mask(self.image_shape, x0, y0, x1, y1)
+        self.set_region('rectangle', {'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1}, mask)
+
+    def on_polygon(self, vertices):
+        mask = polygon_mask(self.image_shape, vertices)
+        self.set_region('polygon', {'vertices': [tuple(vertex) for vertex in vertices]}, mask)
+
+    def set_region(self, kind, geometry, mask):
+        if not mask.any():
+            return
+        self.region = {'kind': kind, 'geometry': geometry, 'mask': mask}
+        self.region_stats = None
+        self.last_clicked_point = None
+        self.coord_label.setText(f'Region: {kind}, {int(mask.sum())} pixels')
+
+        self.update_spectrum(self.slider.value())
+        self.blit()
+
+    def get_region_stats(self):
+        # Statistics depend on the image only, they are computed once per region and image
+        if self.region_stats is None or self.region_stats[0] != self.current_image_index:
+            stats = region_statistics(self.images[self.current_image_index], self.region['mask'].astype(np.int32))
+            self.region_stats = (self.current_image_index, stats)
+        return self.region_stats[1]
+
+    def get_pyramid(self):
+        if self.pyramid_index != self.current_image_index:
+            if self.pyramid is not None:
+                self.pyramid.cancel()
+            self.pyramid = DisplayPyramid(self.images[self.current_image_index], on_ready=self.pyramid_ready.emit)
+            self.pyramid_index = self.current_image_index
+        return self.pyramid
 
     def update_plot(self, channel):
         current_image = self.images[self.current_image_index]
-        self.ax.clear()
-        self.ax.imshow(current_image[:, :, channel], cmap='gray')
-        if self.last_clicked_point:
+        height, width = current_image.shape[:2]
+
+        if self.image_shape != (height, width):
+            self.image_shape = (height, width)
+            self.ax.set_xlim(-0.5, width - 0.5)
+            self.ax.set_ylim(height - 0.5, -0.5)
+
+        feature_map = self.get_feature_map(self.display_feature) if self.display_feature is not None else None
+        if feature_map is not None:
+            self.show_feature_map(self.display_feature, *feature_map)
+            self.update_spectrum(channel)
+            self.canvas.draw_idle()
+            return
+
+        pyramid = self.get_pyramid()
+
+        # Pick the pyramid level that matches the visible part of the image and the canvas size
+        bbox = self.ax.get_window_extent()
+        x0, x1 = self.ax.get_xlim()
+        y0, y1 = self.ax.get_ylim()
+        level = min(pyramid.level_for(abs(x1 - x0), bbox.width), pyramid.level_for(abs(y1 - y0), bbox.height))
+        channel_image, level = pyramid.channel(channel, level)
+
+        # The extent stays in full resolution pixels, so clicks map to the same coordinates on every level
+        shown_height, shown_width = channel_image.shape[0] << level, channel_image.shape[1] << level
+        extent = (-0.5, shown_width - 0.5, shown_height - 0.5, -0.5)
+        if tuple(self.image_artist.get_extent()) != extent:
+            self.image_artist.set_extent(extent)
+
+        self.image_artist.set_data(channel_image)
+        self.image_artist.set_clim(pyramid.clim(channel) or (np.nanmin(channel_image), np.nanmax(channel_image)))
+        if self.display_feature is not None:
+            self.ax.set_title(f'Computing {self.display_feature}...')
+        else:
+            self.ax.set_title(f'Peak wavelength {self.wavelengths[channel]} nm')
+
+        self.update_spectrum(channel)
+
+        # The animated artists are drawn on top in on_draw
+        self.canvas.draw_idle()
+
+    def show_feature_map(self, name, feature_map, clim):
+        height, width = feature_map.shape
+        extent = (-0.5, width - 0.5, height - 0.5, -0.5)
+        if tuple(self.image_artist.get_extent()) != extent:
+            self.image_artist.set_extent(extent)
+
+        self.image_artist.set_data(feature_map)
+        self.image_artist.set_clim(clim)
+        self.ax.set_title(f'{name}: {self.feature_engine.features[name].description}')
+
+    def update_spectrum(self, channel):
+        if self.region is not None and self.region['mask'].shape != self.image_shape:
+            self.region = None  # The region doesn't fit the new image
+
+        if self.region is not None:
+            stats = self.get_region_stats()
+            spectrum, spread = stats['mean'][0], stats['std'][0]
+            title = f'Region mean ± std ({stats["count"][0]} pixels)'
+
+            overlay = self.region['mask'].astype(float)
+            height, width = self.image_shape
+            self.region_artist.set_data(np.ma.masked_where(overlay == 0, overlay))
+            self.region_artist.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+        elif self.last_clicked_point:
+            current_image = self.images[self.current_image_index]
             x, y = self.last_clicked_point
-            self.ax.add_patch(plt.Rectangle((x - 0.5, y - 0.5), 1, 1, edgecolor='red', facecolor='none'))
-
-            # Plotting the spectrum
-            self.spectrum_ax.clear()
-            self.spectrum_ax.plot(self.wavelengths, current_image[y, x, :])
-            self.spectrum_ax.set_ylim([0,1])
-            self.spectrum_ax.set_title('Spectrum at '+ f'{y,x}')
-            self.spectrum_ax.set_xlabel('Wavelength (nm)')
-            self.spectrum_ax.set_ylabel('Reflectance')
-
-            # Marking the selected wavelength on the spectrum
-            selected_wavelength = self.wavelengths[channel]
-            self.spectrum_ax.axvline(x=selected_wavelength, color='red', linestyle='--')
-            self.spectrum_ax.text(selected_wavelength, max(current_image[y, x, :]), f'{selected_wavelength} nm', color='red')
-
-        self.ax.set_title(f'Peak wavelength {self.wavelengths[channel]} nm')
-        self.canvas.draw()
+            spectrum, spread = current_image[y, x, :], None
+            title = 'Spectrum at '+ f'{y,x}'
+            self.marker.set_xy((x - 0.5, y - 0.5))
+        else:
+            return
+
+        self.marker.set_visible(self.region is None)
+        self.region_artist.set_visible(self.region is not None)
+
+        # Plotting the spectrum
+        self.spectrum_line.set_data(self.wavelengths, spectrum)
+        self.spectrum_ax.set_title(title)
+
+        if self.spread_artist is not None:
+            self.spread_artist.remove()
+            self.spread_artist = None
+        if spread is not None:
+            self.spread_artist = self.spectrum_ax.fill_between(self.wavelengths, spectrum - spread, spectrum + spread,
+                                                               alpha=0.3, animated=True)
+
+        # Marking the selected wavelength on the spectrum
+        selected_wavelength = self.wavelengths[channel]
+        self.wavelength_line.set_xdata([selected_wavelength, selected_wavelength])
+        self.wavelength_text.set_position((selected_wavelength, max(spectrum)))
+        self.wavelength_text.set_text(f'{selected_wavelength} nm')
+
+        for artist in (self.spectrum_line, self.wavelength_line, self.wavelength_text):
+            artist.set_visible(True)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for artist in self.animated_artists:
+            self.figure.draw_artist(artist)
+        if self.spread_artist is not None:
+            self.figure.draw_artist(self.spread_artist)
+
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.figure.bbox)
 
     def update_file_name_label(self):
         file_name = self.file_list[self.current_image_index]
         self.file_name_label.setText(f'Current Image: {file_name}')
 
+    def current_image_name(self):
+        return os.path.splitext(os.path.basename(self.file_list[self.current_image_index]))[0]
+
+    def update_annotation_overlay(self):
+        records = self.annotations.get(self.current_image_name(), [])
+        self.annotation_artist.set_offsets(np.array([(record['x'], record['y']) for record in records],
+                                                    dtype=float).reshape(-1, 2))
+        self.canvas.draw_idle()
+
     def get_coordinates(self):
         return self.last_clicked_point
 
     def changeImage(self, index):
+        previous_index = self.current_image_index
         self.current_image_index = index
-        self.update_plot(self.slider.value())
+        try:
+            self.update_plot(self.slider.value())
+        except Exception as e:
+            self.current_image_index = previous_index
+            QMessageBox.warning(self, "Image Not Loaded", f"Could not load {self.file_list[index]}: {e}")
+            return
         self.update_file_name_label()
+        self.update_annotation_overlay()
+        self.images.prefetch(index)
 
     def prev_image(self):
         if self.current_image_index > 0:
@@ -173,48 +517,43 @@ class HSIViewer(QMainWindow):
         if self.current_image_index < len(self.images) - 1:
             self.changeImage(self.current_image_index + 1)
 
+    def closeEvent(self, event):
+        if self.pyramid is not None:
+            self.pyramid.cancel()
+        self.images.close()
+        try:
+            self.annotation_writer.close()
+        except OSError as e:
+            QMessageBox.warning(self, "Annotations Not Saved", f"Could not write {self.annotation_path}: {e}")
+        super().closeEvent(event)
+
     def save_coordinates(self):
-        if self.last_clicked_point is not None:
-            dialog = AnnotationDialog(self)
-            if dialog.exec_():
-                annotation_type, location, patient = dialog.get_details()
-                annotation_dir = os.path.join(self.annotation_dir, patient, location)
-                if not os.path.exists(annotation_dir):
-                    os.makedirs(annotation_dir)
-                with open(annotation_dir+'\\'+annotation_type+'.txt', 'a') as file:
-                    file.write(f"{self.file_list[self.current_image_index]}, {self.last_clicked_point}, {annotation_type}, {location}, {patient}\n")
-                QMessageBox.information(self, "Annotation Saved", "Annotation saved successfully.")
+        if self.region is not None:
+            # Regions are saved at their centroid together with their geometry
+            ys, xs = np.nonzero(self.region['mask'])
+            x, y = int(round(xs.mean())), int(round(ys.mean()))
+            region = {'kind': self.region['kind'], 'geometry': self.region['geometry']}
+        elif self.last_clicked_point is not None:
+            (x, y), region = self.last_clicked_point, None
         else:
             QMessageBox.warning(self, "No Coordinates", "No coordinates to save. Please click on the image first.")
-
-
-
-def group_cu3s_files(base_dir):
-    file_dict = {}
-    file_list = []
-    # Walk through the directory
-    for root, dirs, files in os.walk(base_dir):
-        # Skip the root directory itself
-        if root == base_dir:
-            continue
-
-        # Extract patient name and body part from the path
-        parts = root.split(os.sep)
-        if len(parts) >= 3:
-            patient_name = parts[-2]
-            body_part = parts[-1]
-
-            # Find all .cu3s files in the current directory
-            cu3s_files = glob.glob(os.path.join(root, '*.cu3s'))
-
-            # Add to dictionary
-            if cu3s_files:
-                file_dict.setdefault(patient_name, {}).setdefault(body_part, []).extend(cu3s_files)
-                for file in cu3s_files:
-                    file_list.append(file)
-
-    return file_dict, file_list
-
+            return
+
+        dialog = AnnotationDialog(self)
+        if dialog.exec_():
+            annotation_type, location, patient = dialog.get_details()
+            try:
+                self.annotation_writer.add(self.current_image_name(), x, y, annotation_type, location, patient,
+                                           region=region)
+            except (OSError, RuntimeError) as e:
+                QMessageBox.warning(self, "Annotation Not Saved", f"Could not write {self.annotation_path}: {e}")
+                return
+
+            self.annotations.setdefault(self.current_image_name(), []).append(
+                {'image_name': self.current_image_name(), 'x': x, 'y': y, 'annotation_type': annotation_type,
+                 'body_part': location, 'patient_id': patient, 'region': region})
+            self.update_annotation_overlay()
+            self.statusBar().showMessage("Annotation saved", 2000)
 
 if __name__ == "__main__":
     script_dir = os.path.dirname(os.path.realpath(__file__))
@@ -226,7 +565,7 @@ if __name__ == "__main__":
     processor = HSIProcessor()
     wavelengths = processor.get_wavelengths()
 
-    hsi_dict, file_list = group_cu3s_files(image_dir)
+    hsi_dict, file_list, _ = discover_cu3s_files(image_dir)
 
     app = QApplication(sys.argv)
     ex = HSIViewer(file_list, annotation_dir)